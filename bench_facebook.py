@@ -0,0 +1,295 @@
+"""
+Benchmarks for the Facebook Ads API client against a local stand-in for
+the Graph API, so that they need no tokens or network and can run in CI.
+
+    python bench_facebook.py --output before.json
+    python bench_facebook.py --compare before.json
+
+The stand-in answers with synthetic responses, delayed by --latency
+seconds, with report pages of --rows rows. Canned responses can be
+replayed instead from a --fixtures file of JSON lines such as
+{"method": "GET", "path": "/act_1/reportstats", "status": 200,
+ "body": {...}}.
+"""
+import argparse
+import BaseHTTPServer
+import io
+import json
+import os
+import platform
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+import facebook
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ACCOUNT_ID = 1
+PAGE_ID = 2
+
+
+def report_page(rows, paging=None):
+    """Returns a report stats response of the given number of rows."""
+    return json.dumps({'data': [
+        {'account_id': ACCOUNT_ID, 'adgroup_id': 6000000000000 + i,
+         'date_start': '2014-05-01', 'date_stop': '2014-05-01',
+         'age': '18-24', 'gender': 'female', 'placement': 'desktop',
+         'impressions': 1000 + i, 'clicks': i % 50, 'reach': 900 + i,
+         'spend': i * 0.37, 'cpm': 1.23, 'cpc': 0.45}
+        for i in range(rows)], 'paging': paging or {}})
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """A keep-alive stand-in for graph.facebook.com."""
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write, not one per header line, so that
+    # Nagle's algorithm does not hold it back on keep-alive connections
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        url = urlparse.urlsplit(self.path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        status, data = self.server.route(
+            self.command, url.path, urlparse.parse_qs(url.query), body)
+        payload = data if isinstance(data, str) else json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_DELETE = respond
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Answers batches, paged report stats, uploads and object reads with
+    synthetic responses, or with the canned ones of fixtures.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0, rows=100, pages=10, fixtures=None):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.pages = pages
+        self.fixtures = {}
+        for fixture in fixtures or []:
+            self.fixtures[(fixture['method'], fixture['path'])] = (
+                fixture.get('status', 200), json.dumps(fixture['body']))
+        # All but the paging of a report page, which is added per request
+        self.page = report_page(rows).rsplit(', "paging"', 1)[0]
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def route(self, method, path, query, body):
+        if (method, path) in self.fixtures:
+            return self.fixtures[(method, path)]
+        if method == 'POST' and path == '/':
+            batch = json.loads(urlparse.parse_qs(body)['batch'][0])
+            return 200, [
+                {'code': 200, 'body': json.dumps(
+                    {'id': op['relative_url'].partition('?')[0]})}
+                for op in batch]
+        if path.endswith('/reportstats'):
+            page = int(query.get('after', ['0'])[0])
+            paging = {}
+            if page + 1 < self.pages:
+                paging = {'cursors': {'after': str(page + 1)},
+                          'next': 'https://graph.facebook.com%s' % path}
+            return 200, '%s, "paging": %s}' % (self.page, json.dumps(paging))
+        if method == 'POST':
+            return 200, {'id': path.strip('/'), 'size': len(body)}
+        return 200, {'id': path.strip('/'), 'name': 'Object',
+                     'currency': 'USD'}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def bench_request(api, options):
+    """Sequential GETs through make_request."""
+    for i in xrange(options.requests):
+        api.make_request('%d' % i, 'GET', {'fields': 'name,currency'})
+    return {'ops': options.requests}
+
+
+def bench_batch(api, options):
+    """Batches of BATCH_LIMIT GETs, a round trip each."""
+    batches = max(1, options.requests // 10)
+    for i in xrange(batches):
+        api.make_batch_request([
+            api.get_adgroup(i * api.BATCH_LIMIT + j, batch=True)
+            for j in xrange(api.BATCH_LIMIT)])
+    return {'ops': batches * api.BATCH_LIMIT}
+
+
+def bench_pagination(api, options):
+    """Report stats rows streamed across pages."""
+    rows = 0
+    for row in api.iter_adreport_stats(
+            ACCOUNT_ID, 'last_28_days', 'all_days', ['spend', 'clicks']):
+        rows += 1
+    return {'ops': rows}
+
+
+def bench_upload(api, options):
+    """Multipart uploads of the image and video fixtures."""
+    sent = 0
+    for name, path, field in (
+            ('kodim23.png', 'act_%d/adimages' % ACCOUNT_ID, 'kodim23.png'),
+            ('afm.mp4', '%d/videos' % PAGE_ID, 'source')):
+        filename = os.path.join(HERE, name)
+        with open(filename, 'rb') as f:
+            api.make_request(path, 'POST', {'title': name}, {field: f})
+        sent += os.path.getsize(filename)
+    return {'ops': 2, 'bytes': sent}
+
+
+def bench_decode(api, options):
+    """Decoding a large report response, whole and streamed."""
+    payload = report_page(options.rows * options.pages)
+    rows = len(json.loads(payload)['data'])
+    stream = facebook.JSONStream(io.BytesIO(payload))
+    streamed = sum(1 for row in stream.iter_array('data'))
+    return {'ops': rows + streamed, 'bytes': 2 * len(payload)}
+
+
+BENCHMARKS = [
+    ('request', bench_request),
+    ('batch', bench_batch),
+    ('pagination', bench_pagination),
+    ('upload', bench_upload),
+    ('decode', bench_decode),
+]
+
+TRANSPORTS = {
+    'pooled': facebook.PooledTransport,
+    'urllib': facebook.UrllibTransport,
+}
+
+
+def run(options):
+    """Runs the benchmarks, keeping the best of options.repeat runs."""
+    fixtures = None
+    if options.fixtures:
+        with open(options.fixtures) as f:
+            fixtures = [json.loads(line) for line in f if line.strip()]
+    server = StubServer(options.latency, options.rows, options.pages,
+                        fixtures)
+    server.start()
+    facebook.FACEBOOK_API = server.url
+    results = {}
+    try:
+        for name, bench in BENCHMARKS:
+            if options.only and name not in options.only:
+                continue
+            best = None
+            for _ in xrange(options.repeat):
+                api = facebook.AdsAPI(
+                    'token', 'app_id', 'app_secret',
+                    rate_limiter=facebook.RateLimiter(
+                        options.rate, options.rate),
+                    transport=TRANSPORTS[options.transport]())
+                try:
+                    start = time.time()
+                    result = bench(api, options)
+                    result['seconds'] = time.time() - start
+                finally:
+                    api.close()
+                if best is None or result['seconds'] < best['seconds']:
+                    best = result
+            best['ops_per_second'] = best['ops'] / best['seconds']
+            if 'bytes' in best:
+                best['mb_per_second'] = best['bytes'] / best['seconds'] / 1e6
+            results[name] = best
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'options': dict((key, getattr(options, key)) for key in (
+            'latency', 'rows', 'pages', 'requests', 'repeat', 'rate',
+            'transport')),
+        'results': results,
+    }
+
+
+def compare(baseline, report, threshold):
+    """
+    Prints the throughput of each benchmark against the baseline and
+    returns the names of those more than threshold percent slower.
+    """
+    regressions = []
+    print '%-12s %14s %14s %9s' % ('benchmark', 'baseline', 'current',
+                                   'change')
+    for name, result in sorted(report['results'].items()):
+        before = baseline['results'].get(name)
+        if before is None:
+            print '%-12s %14s %14.1f' % (name, '-', result['ops_per_second'])
+            continue
+        change = (result['ops_per_second'] / before['ops_per_second'] - 1)
+        flag = ''
+        if change * 100 < -threshold:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        print '%-12s %14.1f %14.1f %+8.1f%%%s' % (
+            name, before['ops_per_second'], result['ops_per_second'],
+            change * 100, flag)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the stand-in waits before answering')
+    parser.add_argument('--rows', type=int, default=100,
+                        help='rows per report page')
+    parser.add_argument('--pages', type=int, default=10,
+                        help='report pages')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests of the request benchmark')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each benchmark; the best counts')
+    parser.add_argument('--rate', type=float, default=1e9,
+                        help='requests per second the client may send')
+    parser.add_argument('--transport', choices=sorted(TRANSPORTS),
+                        default='pooled', help='HTTP transport of the client')
+    parser.add_argument('--fixtures', help='JSON lines of canned responses')
+    parser.add_argument('--only', nargs='*', help='benchmarks to run')
+    parser.add_argument('--output', help='file to save the results to')
+    parser.add_argument('--compare', help='results to compare against')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='percent slower that counts as a regression')
+    options = parser.parse_args(argv)
+
+    report = run(options)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        return 1 if compare(baseline, report, options.threshold) else 0
+    for name, result in sorted(report['results'].items()):
+        print '%-12s %10.1f ops/s %8.3fs' % (
+            name, result['ops_per_second'], result['seconds'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
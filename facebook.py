@@ -1,22 +1,59 @@
+import bisect
 import codecs
+import collections
+import copy
 import datetime
+import errno
 import hashlib
 import hmac
+import httplib
+import inspect
 import io
+import itertools
 import json
 import logging
+import math
 import mimetypes
+import multiprocessing
+import os
+import random
+import re
+import socket
+import sqlite3
 import sys
+import threading
+import time
 import urllib
 import urllib2
+import urlparse
 import uuid
+import zlib
+from array import array
+from multiprocessing.pool import ThreadPool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 FACEBOOK_API = 'https://graph.facebook.com'
+AUTH_ERROR_CODES = (102, 190)
+THROTTLE_ERROR_CODES = (4, 17, 32, 613, 80000, 80001, 80002, 80003, 80004,
+                        80005, 80006, 80008, 80009, 80014)
+# The rate limit each throttling error is counted against: the app, the
+# user behind the access token, or the ad account
+THROTTLE_SCOPES = dict(
+    [(4, 'app'), (17, 'token'), (32, 'token')] +
+    [(code, 'account') for code in THROTTLE_ERROR_CODES
+     if code not in (4, 17, 32)])
+SECRET_ARGS = ('access_token', 'input_token')
 
 logger = logging.getLogger(__name__)
 
 
 class MultipartFormdataEncoder(object):
+    CHUNK_SIZE = 64 * 1024
+
     def __init__(self):
         self.boundary = uuid.uuid4().hex
         self.content_type = 'multipart/form-data; boundary={}'.format(
@@ -30,12 +67,13 @@ class MultipartFormdataEncoder(object):
             s = s.decode('utf-8')
         return s
 
-    def iter(self, fields, files):
+    def parts(self, fields, files):
         """
         fields is a sequence of (name, value) elements for regular form fields.
         files is a sequence of (name, file-like) elements for data
         to be uploaded as files.
-        Yield body's chunk as bytes
+        Yield body's parts as (bytes, length) tuples, and the file-like
+        objects themselves in place of their contents.
         """
         encoder = codecs.getencoder('utf-8')
         for key, value in fields.iteritems():
@@ -55,10 +93,23 @@ class MultipartFormdataEncoder(object):
             yield encoder(self.u('Content-Disposition: form-data; name="{}"; filename="{}"\r\n').format(key, filename))
             yield encoder('Content-Type: {}\r\n'.format(mimetypes.guess_type(filename)[0] or 'application/octet-stream'))
             yield encoder('\r\n')
-            buff = value.read()
-            yield (buff, len(buff))
+            yield value
             yield encoder('\r\n')
-        yield encoder('--{}--\r\b'.format(self.boundary))
+        yield encoder('--{}--\r\n'.format(self.boundary))
+
+    def iter(self, fields, files, chunk_size=CHUNK_SIZE):
+        """
+        Yield body's chunk as bytes, reading files chunk_size bytes at a time.
+        """
+        for part in self.parts(fields, files):
+            if isinstance(part, tuple):
+                yield part
+                continue
+            while True:
+                buff = part.read(chunk_size)
+                if not buff:
+                    break
+                yield (buff, len(buff))
 
     def encode(self, fields, files):
         body = io.BytesIO()
@@ -66,6 +117,1449 @@ class MultipartFormdataEncoder(object):
             body.write(chunk)
         return self.content_type, body.getvalue()
 
+    def stream(self, fields, files, chunk_size=CHUNK_SIZE):
+        """
+        Returns the content type and a MultipartBody that produces the
+        body in chunks while it is being sent.
+        """
+        parts = []
+        for part in self.parts(fields, files):
+            if isinstance(part, tuple):
+                parts.append(part[0])
+            else:
+                parts.append((part, part.tell(), file_size(part)))
+        return self.content_type, MultipartBody(parts, chunk_size)
+
+
+def concurrent_map(func, items, workers):
+    """Like map(), but runs up to workers calls at once on a thread pool."""
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return map(func, items)
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+
+
+def endpoint_template(path):
+    """Returns path with its object IDs replaced, e.g. act_{id}/adgroups."""
+    return re.sub(r'(^|/)(act_)?\d+(_\d+)?(?=/|$)',
+                  lambda m: '%s%s{id}' % (m.group(1), m.group(2) or ''), path)
+
+
+def parse_relative_url(relative_url):
+    """Returns the path and args of the relative_url of a batch request."""
+    path, _, query = relative_url.partition('?')
+    return path, dict(urlparse.parse_qsl(query, keep_blank_values=True))
+
+
+def batch_reference(name, path='$.id'):
+    """Returns a reference to the result of the named batch operation."""
+    return '{result=%s:%s}' % (name, path)
+
+
+def unescape_references(query):
+    """Undoes the URL encoding of batch references in query."""
+    return re.sub(r'%7Bresult%3D.*?%7D',
+                  lambda m: urllib.unquote(m.group(0)), query)
+
+
+def redact(args):
+    """Returns a copy of args with its tokens hidden, for logging."""
+    return dict((key, '<redacted>' if key in SECRET_ARGS else value)
+                for key, value in args.iteritems())
+
+
+def redact_url(relative_url):
+    """Returns relative_url with the tokens in its query hidden."""
+    return re.sub(r'((?:%s)=)[^&]*' % '|'.join(SECRET_ARGS),
+                  r'\1<redacted>', relative_url)
+
+
+def content_length(headers):
+    """Returns the Content-Length of the headers, or 0."""
+    try:
+        return int(headers.get('Content-Length') or 0)
+    except ValueError:
+        return 0
+
+
+def is_dependent(request):
+    """Returns whether a batch operation is named or refers to another."""
+    return ('name' in request or 'depends_on' in request or
+            '{result=' in request['relative_url'])
+
+
+def time_windows(start, end, days):
+    """
+    Returns the consecutive (start, end) windows of at most days days that
+    cover start to end; like those of get_time_interval, the ends are
+    inclusive.
+    """
+    windows = []
+    while start <= end:
+        stop = min(start + datetime.timedelta(days - 1), end)
+        windows.append((start, stop))
+        start = stop + datetime.timedelta(1)
+    return windows
+
+
+class JSONStream(object):
+    """
+    Decodes JSON read from a file-like object a value at a time, keeping
+    only the undecoded remainder of the current chunk in memory.
+    """
+    WHITESPACE = u' \t\r\n'
+    decoder = json.JSONDecoder()
+
+    def __init__(self, f, chunk_size=64 * 1024):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.text = codecs.getincrementaldecoder('utf-8')()
+        self.buff = u''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Reads another chunk; returns False at the end of the input."""
+        if self.eof:
+            return False
+        data = self.f.read(self.chunk_size)
+        self.eof = not data
+        self.buff = self.buff[self.pos:] + self.text.decode(data, self.eof)
+        self.pos = 0
+        return not self.eof
+
+    def peek(self):
+        """Skips whitespace and returns the next character, or u''."""
+        while True:
+            while self.pos < len(self.buff) and \
+                    self.buff[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buff):
+                return self.buff[self.pos]
+            if not self.fill():
+                return u''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected %r in JSON stream' % char)
+        self.pos += 1
+
+    def value(self):
+        """Decodes the next value, reading as many chunks as it needs."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buff, self.pos)
+                # A number may go on in the next chunk
+                if end < len(self.buff) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def elements(self):
+        """Yields the elements of the array that comes next."""
+        self.expect('[')
+        while True:
+            char = self.peek()
+            if char == ']':
+                self.pos += 1
+                return
+            if char == ',':
+                self.pos += 1
+                continue
+            if not char:
+                raise ValueError('Unterminated array in JSON stream')
+            yield self.value()
+
+    def iter_array(self, key, rest=None):
+        """
+        Yields the elements of the array under key in the object that
+        comes next, or of the array itself if a bare array comes next. The
+        other members of the object are decoded into rest.
+        """
+        if self.peek() == '[':
+            for value in self.elements():
+                yield value
+            return
+        self.expect('{')
+        while True:
+            char = self.peek()
+            if char == '}':
+                self.pos += 1
+                return
+            if char == ',':
+                self.pos += 1
+                continue
+            name = self.value()
+            self.expect(':')
+            if name == key and self.peek() == '[':
+                for value in self.elements():
+                    yield value
+            else:
+                value = self.value()
+                if rest is not None:
+                    rest[name] = value
+
+
+def iter_json_array(f, key='data', rest=None):
+    """Yields the rows of a list response read from f one at a time."""
+    return JSONStream(f).iter_array(key, rest)
+
+
+class LazyBatchResponse(object):
+    """
+    The responses to a batched request, each body decoded only when it is
+    accessed, and again on every access, so that large bodies are not all
+    held decoded at once. Assigned responses are kept as they are.
+    """
+    def __init__(self, raw):
+        self.raw = raw
+        self.values = {}
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in xrange(*idx.indices(len(self)))]
+        idx = xrange(len(self))[idx]
+        if idx in self.values:
+            return self.values[idx]
+        val = self.raw[idx]
+        return None if val is None else json.loads(val['body'])
+
+    def __setitem__(self, idx, value):
+        self.values[xrange(len(self))[idx]] = value
+
+    def __iter__(self):
+        for idx in xrange(len(self)):
+            yield self[idx]
+
+    def ok(self, idx):
+        """Returns whether the operation succeeded, without decoding it."""
+        val = self.raw[idx]
+        return (idx not in self.values and val is not None and
+                val.get('code', 200) < 400)
+
+    def extend(self, responses):
+        offset = len(self.raw)
+        if isinstance(responses, LazyBatchResponse):
+            self.raw.extend(responses.raw)
+            for idx, value in responses.values.items():
+                self.values[offset + idx] = value
+            return
+        for idx, value in enumerate(responses):
+            self.raw.append(None)
+            self.values[offset + idx] = value
+
+
+class BatchBuilder(object):
+    """
+    Builds a batch of operations that can refer to the results of earlier
+    ones, and sends it in a single batched request. Named operations are
+    answered even when others refer to them, so the IDs of everything
+    created come back together.
+    """
+    def __init__(self, api):
+        self.api = api
+        self.operations = []
+        self.names = set()
+        self.results = {}
+
+    def __len__(self):
+        return len(self.operations)
+
+    def add(self, request, name=None, depends_on=None):
+        """
+        Adds a request returned by a method called with batch=True. If it
+        is named, returns a reference to its ID to pass to later calls.
+        """
+        if len(self.operations) >= self.api.BATCH_LIMIT:
+            raise ValueError('A batch takes at most %d operations' %
+                             self.api.BATCH_LIMIT)
+        if name in self.names:
+            raise ValueError('Duplicate batch operation name %s' % name)
+        if depends_on is not None and depends_on not in self.names:
+            raise ValueError('Unknown batch operation name %s' % depends_on)
+        request = dict(request)
+        if name is not None:
+            request.update(name=name, omit_response_on_success=False)
+            self.names.add(name)
+        if depends_on is not None:
+            request['depends_on'] = depends_on
+        self.operations.append(request)
+        if name is not None:
+            return self.ref(name)
+
+    def ref(self, name, path='$.id'):
+        """Returns a reference to the result of the named operation."""
+        if name not in self.names:
+            raise ValueError('Unknown batch operation name %s' % name)
+        return batch_reference(name, path)
+
+    def execute(self):
+        """
+        Sends the batch and returns the responses in order; those of named
+        operations are also kept in results by name.
+        """
+        responses = self.api.make_batch_request(self.operations)
+        if not isinstance(responses, list):
+            if responses is None:
+                raise urllib2.URLError('no response to the batch')
+            raise AdsAPIError(responses)
+        for request, response in zip(self.operations, responses):
+            if 'name' in request:
+                self.results[request['name']] = response
+        return responses
+
+
+class Future(object):
+    """
+    The eventual response to a deferred call, or its error. The Future of
+    a call queued in a DeferredBatch sends the batch when its result is
+    asked for before the batch has been sent.
+    """
+    def __init__(self, batch=None):
+        self.batch = batch
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def set_result(self, value):
+        self.value = value
+        self.event.set()
+
+    def set_exception(self, error):
+        self.error = error
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        """Waits for the response and returns it, or raises its error."""
+        if not self.done() and self.batch is not None:
+            self.batch.flush()
+        if not self.event.wait(timeout):
+            raise RuntimeError('The deferred call has not been answered yet')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class DeferredBatch(object):
+    """
+    A context in which the AdsAPI methods taking batch queue their request
+    and return a Future instead of sending it. The queued requests are sent
+    in one batched request once size of them are queued, once the first of
+    them has waited max_wait seconds, and when the context exits. Each
+    Future resolves to its own response, or raises AdsAPIError or
+    urllib2.URLError. Other methods are called directly.
+    """
+    def __init__(self, api, size=None, max_wait=None):
+        self.api = api
+        self.size = min(size or api.BATCH_LIMIT, api.BATCH_LIMIT)
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.queue = []
+        self.timer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if not inspect.ismethod(attr) or \
+                'batch' not in inspect.getargspec(attr).args:
+            return attr
+
+        def method(*args, **kwargs):
+            kwargs['batch'] = True
+            return self.defer(attr(*args, **kwargs))
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        setattr(self, name, method)
+        return method
+
+    def defer(self, request):
+        """Queues a request built with batch=True, returning its Future."""
+        future = Future(self)
+        with self.lock:
+            self.queue.append((request, future))
+            full = len(self.queue) >= self.size
+            if not full and self.max_wait is not None and self.timer is None:
+                self.timer = threading.Timer(self.max_wait, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+        return future
+
+    def flush(self):
+        """Sends the queued requests and resolves their futures."""
+        with self.lock:
+            queue, self.queue = self.queue, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if not queue:
+            return
+        requests = [request for request, _ in queue]
+        try:
+            responses = self.api.make_batch_request(requests)
+        except Exception as e:
+            responses = [e] * len(queue)
+        if not isinstance(responses, list):
+            responses = [responses] * len(queue)
+        for (_, future), response in zip(queue, responses):
+            if response is None:
+                future.set_exception(urllib2.URLError('no response'))
+            elif isinstance(response, Exception):
+                future.set_exception(response)
+            elif isinstance(response, dict) and 'error' in response:
+                future.set_exception(AdsAPIError(response))
+            else:
+                future.set_result(response)
+
+
+def file_size(f):
+    """Returns the number of bytes left to read from the given file."""
+    try:
+        return os.fstat(f.fileno()).st_size - f.tell()
+    except (AttributeError, IOError, OSError, io.UnsupportedOperation):
+        pos = f.tell()
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        f.seek(pos)
+        return end - pos
+
+
+class MultipartBody(object):
+    """
+    A multipart body whose length is known up front and whose contents are
+    produced in fixed-size chunks, so that peak memory stays at one chunk
+    regardless of the size of the files. Iterating again starts over from
+    the beginning, which lets a failed send be retried.
+    """
+    def __init__(self, parts, chunk_size):
+        self.parts = parts
+        self.chunk_size = chunk_size
+        self.length = sum(len(part) if isinstance(part, bytes) else part[2]
+                          for part in parts)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        buff = bytearray()
+        for part in self.parts:
+            if isinstance(part, bytes):
+                buff.extend(part)
+            else:
+                f, offset, remaining = part
+                f.seek(offset)
+                while remaining > 0:
+                    data = f.read(min(self.chunk_size, remaining))
+                    if not data:
+                        raise IOError('%s is shorter than expected' % f.name)
+                    remaining -= len(data)
+                    buff.extend(data)
+                    while len(buff) >= self.chunk_size:
+                        yield bytes(buff[:self.chunk_size])
+                        del buff[:self.chunk_size]
+            while len(buff) >= self.chunk_size:
+                yield bytes(buff[:self.chunk_size])
+                del buff[:self.chunk_size]
+        if buff:
+            yield bytes(buff)
+
+
+class FileSlice(object):
+    """
+    A read-only view of length bytes of a file starting at offset. Slices
+    of the same file may be read from several threads at once as long as
+    they share the given lock.
+    """
+    def __init__(self, f, offset, length, lock):
+        self.f = f
+        self.offset = offset
+        self.length = length
+        self.lock = lock
+        self.name = f.name
+        self.pos = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.pos = max(0, min(offset, self.length))
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        remaining = self.length - self.pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        with self.lock:
+            self.f.seek(self.offset + self.pos)
+            data = self.f.read(size)
+        self.pos += len(data)
+        return data
+
+
+class PooledResponse(object):
+    """
+    A response read from a pooled connection. The connection is handed back
+    to its pool as soon as the body has been read to the end, or discarded
+    when the response is closed early.
+    """
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=None):
+        if self.conn is None:
+            return ''
+        try:
+            data = self.response.read(amt)
+        except (socket.error, httplib.HTTPException):
+            self.close()
+            raise
+        if self.response.isclosed():
+            self.release()
+        return data
+
+    def release(self):
+        """Returns a fully read connection to the pool."""
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            self.pool.release(self.key, conn, self.response.will_close)
+
+    def close(self):
+        """Discards the connection unless the body was read to the end."""
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            self.pool.release(self.key, conn, not self.response.isclosed())
+
+
+class DecodedResponse(object):
+    """
+    A gzip or deflate encoded response, decompressed as it is read so that
+    the decompressed body is never held whole unless it is read whole.
+    Deflate bodies may come with or without their zlib header.
+    """
+    def __init__(self, f, chunk_size=64 * 1024):
+        self.f = f
+        self.chunk_size = chunk_size
+        # Accepts both the gzip and the zlib headers
+        self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        # The input read before any output, to start over as raw deflate
+        self.head = ''
+        self.buffer = ''
+        self.eof = False
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def info(self):
+        return self.f.info()
+
+    def getcode(self):
+        return self.f.getcode()
+
+    def fill(self):
+        data = self.f.read(self.chunk_size)
+        if data:
+            if self.head is not None:
+                self.head += data
+            try:
+                self.buffer += self.decompressor.decompress(data)
+            except zlib.error:
+                if self.head is None:
+                    raise
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                self.buffer += self.decompressor.decompress(self.head)
+            if self.buffer:
+                self.head = None
+        else:
+            self.buffer += self.decompressor.flush()
+            self.eof = True
+
+    def read(self, amt=None):
+        while not self.eof and (amt is None or len(self.buffer) < amt):
+            self.fill()
+        if amt is None:
+            amt = len(self.buffer)
+        data, self.buffer = self.buffer[:amt], self.buffer[amt:]
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def decode_response(f):
+    """Returns f, decompressing its body if it has a Content-Encoding."""
+    encoding = (f.info().get('Content-Encoding') or '').lower()
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        return DecodedResponse(f)
+    return f
+
+
+def gzip_compress(data):
+    """Returns data compressed in the gzip format."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of keep-alive HTTP(S) connections.
+    At most maxsize connections are checked out at once; idle connections
+    older than idle_timeout seconds are closed on the next checkout.
+    """
+    def __init__(self, maxsize=10, timeout=None, idle_timeout=60):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxsize)
+        self._idle = {}
+
+    def _new_connection(self, key):
+        scheme, host, port = key
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, **kwargs)
+        return httplib.HTTPConnection(host, port, **kwargs)
+
+    def reap(self):
+        """Closes connections that have been idle for too long."""
+        deadline = time.time() - self.idle_timeout
+        with self._lock:
+            for key, conns in self._idle.items():
+                stale = [conn for conn, used in conns if used < deadline]
+                conns[:] = [(c, used) for c, used in conns if used >= deadline]
+                for conn in stale:
+                    conn.close()
+
+    def checkout(self, key, new=False):
+        """Returns (connection, reused) for the given key."""
+        self._slots.acquire()
+        self.reap()
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns and not new:
+                return conns.pop()[0], True
+        return self._new_connection(key), False
+
+    def release(self, key, conn, discard=False):
+        if discard:
+            conn.close()
+        else:
+            with self._lock:
+                self._idle.setdefault(key, []).append((conn, time.time()))
+        self._slots.release()
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            for conns in self._idle.values():
+                for conn, used in conns:
+                    conn.close()
+            self._idle.clear()
+
+    def send(self, conn, method, selector, body, headers):
+        """
+        Sends a request; body is either bytes or a re-iterable of chunks,
+        such as a MultipartBody, whose length is given in the headers.
+        """
+        if body is None or isinstance(body, basestring):
+            conn.request(method, selector, body, headers)
+            return
+        names = set(name.lower() for name in headers)
+        conn.putrequest(method, selector, skip_host='host' in names,
+                        skip_accept_encoding='accept-encoding' in names)
+        for name, value in headers.iteritems():
+            conn.putheader(name, value)
+        conn.endheaders()
+        for chunk in body:
+            conn.send(chunk)
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Sends a request over a pooled connection and returns the response,
+        whatever its status. Raises urllib2.URLError when the request could
+        not be sent.
+        """
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        selector = parts.path or '/'
+        if parts.query:
+            selector = '%s?%s' % (selector, parts.query)
+        headers = dict(headers or {})
+        for attempt in (1, 2):
+            conn, reused = self.checkout(key, new=attempt > 1)
+            try:
+                self.send(conn, method, selector, body, headers)
+                return PooledResponse(self, key, conn, conn.getresponse(), url)
+            except (socket.error, httplib.HTTPException) as e:
+                self.release(key, conn, True)
+                # The server may have dropped the idle keep-alive connection
+                # before reading the request; resend it once on a new one.
+                if not reused or not self.is_dropped(e):
+                    raise urllib2.URLError(e)
+
+    @staticmethod
+    def is_dropped(error):
+        """
+        Returns whether error shows that the connection was closed before
+        any response; a timeout does not, as the request may be running.
+        """
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        return (isinstance(error, socket.error) and
+                not isinstance(error, socket.timeout) and
+                error.errno in (errno.ECONNRESET, errno.EPIPE))
+
+    def urlopen(self, method, url, body=None, headers=None):
+        """
+        Sends a request over a pooled connection. Errors are raised as
+        urllib2.HTTPError and urllib2.URLError, like urllib2.urlopen does.
+        """
+        f = self.request(method, url, body, headers)
+        if f.code >= 400:
+            data = f.read()
+            raise urllib2.HTTPError(
+                url, f.code, f.msg, f.headers, io.BytesIO(data))
+        return f
+
+
+class Transport(object):
+    """
+    How AdsAPI requests reach the API. send() returns a file-like response
+    with read(amt), info(), getcode() and close(), whatever its status,
+    and raises urllib2.URLError when no response could be had. The body
+    is None, a string, or a re-iterable of chunks, such as a
+    MultipartBody, whose length is given in the headers.
+    """
+    def send(self, method, url, headers, body=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class UrllibTransport(Transport):
+    """
+    Sends each request with urllib2 on a connection of its own. Chunked
+    bodies are joined before they are sent.
+    """
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def send(self, method, url, headers, body=None):
+        if body is not None and not isinstance(body, basestring):
+            body = ''.join(body)
+        request = urllib2.Request(url, body, headers)
+        request.get_method = lambda: method
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        try:
+            return urllib2.urlopen(request, **kwargs)
+        except urllib2.HTTPError as e:
+            # An error response is a response all the same
+            return e
+
+
+class PooledTransport(Transport):
+    """Sends requests over a ConnectionPool of keep-alive connections."""
+    def __init__(self, pool=None):
+        self.pool = pool or ConnectionPool()
+
+    def send(self, method, url, headers, body=None):
+        return self.pool.request(method, url, body, headers)
+
+    def close(self):
+        self.pool.close()
+
+
+class ResponseCache(object):
+    """
+    A size-bounded LRU cache of GET responses, keyed on the path and the
+    canonicalized args other than the access token, so a cache should not
+    be shared by clients using different tokens. Entries live for the TTL
+    of their endpoint template in ttls, or for ttl seconds. The default ttl
+    of 0 caches only the near-static endpoints listed in ttls, never
+    volatile ones such as report stats or async job statuses.
+    """
+    TTLS = {
+        'act_{id}': 3600,
+        'act_{id}/offsitepixels': 3600,
+        'act_{id}/remarketingpixelcode': 86400,
+        '{id}/accounts': 3600,
+    }
+
+    def __init__(self, maxsize=1024, ttl=0, ttls=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.ttls = dict(self.TTLS, **(ttls or {}))
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(path, args):
+        args = urlparse.parse_qsl(urllib.urlencode(args or {}), True)
+        return path, tuple(sorted(arg for arg in args
+                                  if arg[0] != 'access_token'))
+
+    def get(self, path, args):
+        """Returns a copy of the cached response, or None."""
+        key = self.key(path, args)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+        return copy.deepcopy(entry[1])
+
+    def set(self, path, args, response):
+        """Caches a successful response for the TTL of its endpoint."""
+        ttl = self.ttls.get(endpoint_template(path), self.ttl)
+        if not ttl or response is None or (
+                isinstance(response, dict) and 'error' in response):
+            return
+        key = self.key(path, args)
+        entry = (time.time() + ttl, copy.deepcopy(response))
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, path):
+        """Drops the entries of the object a write to path affects."""
+        obj = path.split('/')[0]
+        with self._lock:
+            for key in self._entries.keys():
+                if key[0].split('/')[0] == obj:
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries)}
+
+
+class SingleFlight(object):
+    """
+    Lets identical calls made while the first of them is in flight wait
+    for its result, or its error, instead of repeating it. Nothing is kept
+    once the call returns, and every caller gets its own copy.
+    """
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """Returns func(), or the result of the identical call in flight."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+                call.followers = 0
+            else:
+                call.followers += 1
+                self.shared += 1
+        if not leader:
+            return copy.deepcopy(call.result())
+        try:
+            value = func()
+        except Exception as e:
+            with self._lock:
+                del self._calls[key]
+            call.set_exception(e)
+            raise
+        with self._lock:
+            del self._calls[key]
+        call.set_result(value)
+        return copy.deepcopy(value) if call.followers else value
+
+
+class Metrics(object):
+    """
+    Request metrics keyed by endpoint template, such as
+    act_{id}/reportstats: calls, a latency histogram with bounds in
+    seconds, bytes sent and received, errors by code, cache hits and
+    misses, plus a histogram of batch sizes. Batched operations are
+    counted for their own endpoint, and the batched request itself under
+    'batch'. Export them with snapshot() or prometheus().
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    BATCH_BUCKETS = (1, 5, 10, 25, 50)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self.endpoints = {}
+        self.batch_sizes = [0] * (len(self.BATCH_BUCKETS) + 1)
+        self.batch_sum = 0
+        self._lock = threading.Lock()
+
+    def endpoint(self, path):
+        """Returns the stats of the endpoint of path; hold the lock."""
+        template = endpoint_template(
+            path.partition('?')[0].strip('/')) or 'batch'
+        stats = self.endpoints.get(template)
+        if stats is None:
+            stats = self.endpoints[template] = {
+                'calls': 0, 'batched': 0,
+                'latency': [0] * (len(self.buckets) + 1), 'latency_sum': 0.0,
+                'bytes_sent': 0, 'bytes_received': 0, 'errors': {},
+                'cache_hits': 0, 'cache_misses': 0,
+            }
+        return stats
+
+    def observe(self, path, latency, sent=0, received=0):
+        """Records a request to path that took latency seconds."""
+        with self._lock:
+            stats = self.endpoint(path)
+            stats['calls'] += 1
+            stats['latency'][bisect.bisect_left(self.buckets, latency)] += 1
+            stats['latency_sum'] += latency
+            stats['bytes_sent'] += sent
+            stats['bytes_received'] += received
+
+    def error(self, path, code):
+        """Records an error response to path with the given code."""
+        with self._lock:
+            errors = self.endpoint(path)['errors']
+            errors[code] = errors.get(code, 0) + 1
+
+    def cache(self, path, hit):
+        with self._lock:
+            self.endpoint(path)['cache_hits' if hit else 'cache_misses'] += 1
+
+    def batch(self, batch):
+        """Records a batched request of the given operations."""
+        with self._lock:
+            self.batch_sizes[
+                bisect.bisect_left(self.BATCH_BUCKETS, len(batch))] += 1
+            self.batch_sum += len(batch)
+            for request in batch:
+                self.endpoint(request['relative_url'])['batched'] += 1
+
+    @staticmethod
+    def cumulative(bounds, counts):
+        total = 0
+        result = collections.OrderedDict()
+        for bound, count in zip(list(bounds) + ['+Inf'], counts):
+            total += count
+            result[str(bound)] = total
+        return result
+
+    def snapshot(self):
+        """Returns the metrics as a dict of plain values."""
+        with self._lock:
+            endpoints = copy.deepcopy(self.endpoints)
+            batch_sizes = list(self.batch_sizes)
+            batch_sum = self.batch_sum
+        for stats in endpoints.values():
+            stats['latency'] = self.cumulative(self.buckets, stats['latency'])
+        return {
+            'endpoints': endpoints,
+            'batch_sizes': self.cumulative(self.BATCH_BUCKETS, batch_sizes),
+            'batch_sum': batch_sum,
+        }
+
+    def prometheus(self, prefix='facebook_ads'):
+        """Returns the metrics in the Prometheus text format."""
+        snapshot = self.snapshot()
+        endpoints = sorted(snapshot['endpoints'].items())
+        lines = []
+
+        def label(template):
+            return 'endpoint="%s"' % template.replace(
+                '\\', '\\\\').replace('"', '\\"')
+        for name, key in (('requests_total', 'calls'),
+                          ('batched_operations_total', 'batched'),
+                          ('bytes_sent_total', 'bytes_sent'),
+                          ('bytes_received_total', 'bytes_received'),
+                          ('cache_hits_total', 'cache_hits'),
+                          ('cache_misses_total', 'cache_misses')):
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            for template, stats in endpoints:
+                lines.append('%s_%s{%s} %s' % (
+                    prefix, name, label(template), stats[key]))
+        lines.append('# TYPE %s_errors_total counter' % prefix)
+        for template, stats in endpoints:
+            for code, count in sorted(stats['errors'].items()):
+                lines.append('%s_errors_total{%s,code="%s"} %d' % (
+                    prefix, label(template), code, count))
+        lines.append('# TYPE %s_request_seconds histogram' % prefix)
+        for template, stats in endpoints:
+            for bound, count in stats['latency'].items():
+                lines.append('%s_request_seconds_bucket{%s,le="%s"} %d' % (
+                    prefix, label(template), bound, count))
+            lines.append('%s_request_seconds_sum{%s} %r' % (
+                prefix, label(template), stats['latency_sum']))
+            lines.append('%s_request_seconds_count{%s} %d' % (
+                prefix, label(template), stats['calls']))
+        lines.append('# TYPE %s_batch_size histogram' % prefix)
+        for bound, count in snapshot['batch_sizes'].items():
+            lines.append('%s_batch_size_bucket{le="%s"} %d' % (
+                prefix, bound, count))
+        lines.append('%s_batch_size_sum %d' % (prefix, snapshot['batch_sum']))
+        lines.append('%s_batch_size_count %d' % (
+            prefix, snapshot['batch_sizes']['+Inf']))
+        return '\n'.join(lines) + '\n'
+
+
+class PageTokenCache(object):
+    """
+    Page access tokens keyed by page ID. A token expires at the expires_at
+    reported by debug_token, where 0 means never, and is refreshed
+    refresh seconds ahead of it.
+    """
+    def __init__(self, refresh=300):
+        self.refresh = refresh
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get(self, page_id):
+        """Returns the token of the page unless it is about to expire."""
+        with self._lock:
+            token, expires_at = self._tokens.get(str(page_id), (None, 0))
+        if expires_at and expires_at - self.refresh < time.time():
+            return None
+        return token
+
+    def set(self, page_id, token, expires_at=0):
+        with self._lock:
+            self._tokens[str(page_id)] = (token, expires_at)
+
+    def evict(self, page_id):
+        with self._lock:
+            self._tokens.pop(str(page_id), None)
+
+
+class RetryPolicy(object):
+    """
+    Which failed requests to retry, and when. Requests of the idempotent
+    methods are retried on network errors, on the given HTTP statuses and
+    on the given API error codes; throttled requests of any method are
+    retried too, since the API did not process them. A request is tried
+    at most max_attempts times, with exponential backoff and full jitter
+    in between, and never past deadline seconds after the first attempt.
+    """
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=30,
+                 deadline=None, methods=('GET',),
+                 statuses=(500, 502, 503, 504), codes=(1, 2)):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.methods = methods
+        self.statuses = statuses
+        self.codes = codes
+
+    def retryable(self, method, status=None, code=None):
+        """Returns whether a failure with the status and code is retried."""
+        if code in THROTTLE_ERROR_CODES:
+            return True
+        if method not in self.methods:
+            return False
+        return ((status is None and code is None) or
+                status in self.statuses or code in self.codes)
+
+    def delay(self, attempt, start):
+        """Returns the seconds to wait before retrying, or None to give up."""
+        if attempt >= self.max_attempts:
+            return None
+        delay = random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        if self.deadline is not None and \
+                time.time() + delay - start > self.deadline:
+            return None
+        return delay
+
+
+class TokenBucket(object):
+    """A token bucket whose rate is scaled down under pressure."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+        self.scale = 1.0
+        self.backoff = 0
+        self.blocked_until = 0
+
+    def wait(self, n, now):
+        """Returns the seconds to wait before n tokens can be taken."""
+        self.tokens = min(self.capacity, self.tokens + (
+            now - self.updated) * self.rate * self.scale)
+        self.updated = now
+        wait = max(0, self.blocked_until - now)
+        if self.tokens < n:
+            wait = max(wait, (n - self.tokens) / (self.rate * self.scale))
+        return wait
+
+
+class RateLimiter(object):
+    """
+    A client-side request scheduler with token buckets per app, per access
+    token and per ad account. The usage headers of every response slow the
+    buckets down once usage passes threshold percent, and throttling errors
+    block the bucket of their scope in THROTTLE_SCOPES, or the token bucket
+    when the request has none, for an exponentially growing backoff that
+    decays again with successful calls. Share one RateLimiter between
+    AdsAPI instances to schedule all of their calls together.
+    """
+    USAGE_HEADERS = ('X-App-Usage', 'X-Ad-Account-Usage',
+                     'X-Business-Use-Case-Usage')
+
+    def __init__(self, rate=100.0, burst=100, threshold=75, max_backoff=300):
+        self.rate = rate
+        self.burst = burst
+        self.threshold = threshold
+        self.max_backoff = max_backoff
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, key):
+        if key not in self._buckets:
+            self._buckets[key] = TokenBucket(self.rate, self.burst)
+        return self._buckets[key]
+
+    def acquire(self, keys, n=1):
+        """Blocks until n requests may be made for all of the keys."""
+        n = min(n, self.burst)
+        while True:
+            with self._lock:
+                now = time.time()
+                buckets = [self.bucket(key) for key in keys]
+                wait = max(bucket.wait(n, now) for bucket in buckets)
+                if not wait:
+                    for bucket in buckets:
+                        bucket.tokens -= n
+                    return
+            logger.debug('Throttling %s for %.2fs', keys, wait)
+            time.sleep(wait)
+
+    def usage(self, headers):
+        """Returns the highest usage percent reported by each header."""
+        usage = {}
+        for name in self.USAGE_HEADERS:
+            value = headers.get(name)
+            if not value:
+                continue
+            try:
+                data = json.loads(value)
+            except ValueError:
+                continue
+            if name == 'X-Business-Use-Case-Usage':
+                values = [item.get(field, 0)
+                          for items in data.values() for item in items
+                          for field in ('call_count', 'total_time',
+                                        'total_cputime')]
+            else:
+                values = data.values()
+            usage[name] = max([value for value in values
+                               if isinstance(value, (int, float))] or [0])
+        return usage
+
+    def update(self, keys, headers, code=None):
+        """Adapts the buckets of keys to a response and its error code."""
+        usage = self.usage(headers) if headers is not None else {}
+        throttled = []
+        if code in THROTTLE_ERROR_CODES:
+            throttled = [key for key in keys
+                         if key[0] == THROTTLE_SCOPES[code]] or \
+                [key for key in keys if key[0] == 'token']
+        with self._lock:
+            now = time.time()
+            for key in keys:
+                bucket = self.bucket(key)
+                if key[0] == 'account':
+                    names = ('X-Ad-Account-Usage', 'X-Business-Use-Case-Usage')
+                else:
+                    names = ('X-App-Usage',)
+                pct = max([usage[name] for name in names if name in usage]
+                          or [0])
+                bucket.scale = 1.0
+                if pct > self.threshold:
+                    bucket.scale = max(
+                        0.05, (100.0 - pct) / (100 - self.threshold))
+                if key in throttled:
+                    bucket.backoff = min(self.max_backoff,
+                                         max(1, bucket.backoff * 2))
+                    bucket.blocked_until = now + bucket.backoff
+                    bucket.tokens = 0
+                elif code is None:
+                    bucket.backoff /= 2.0
+
+
+class ReportColumn(object):
+    """
+    A column of report values. Its kind follows from the first value
+    that is not null: numbers go into an array of doubles with NaN for
+    nulls, strings are dictionary-encoded into an array of codes with -1
+    for nulls, and anything else is kept in a list. A value that does not
+    fit the kind turns the column into a list.
+
+    Strings are read as numbers only in the METRICS columns, which the API
+    may send as strings. The IDs of *_id columns are always kept as
+    strings, so that they keep all their digits.
+    """
+    METRICS = frozenset([
+        'impressions', 'unique_impressions', 'social_impressions',
+        'clicks', 'unique_clicks', 'social_clicks', 'reach',
+        'social_reach', 'frequency', 'spend', 'cpm', 'cpc', 'cpp', 'ctr',
+        'unique_ctr', 'total_actions', 'total_unique_actions',
+        'cost_per_total_action', 'cost_per_unique_click',
+        'newsfeed_position', 'relevance_score'])
+
+    def __init__(self, name, nulls=0):
+        self.name = name
+        self.kind = None
+        self.nulls = nulls
+        self.data = None
+        self.dictionary = []
+        self.index = {}
+
+    def __len__(self):
+        return self.nulls if self.data is None else len(self.data)
+
+    @property
+    def is_id(self):
+        return self.name == 'id' or self.name.endswith('_id')
+
+    def number(self, value):
+        if isinstance(value, bool) or self.is_id:
+            return None
+        if isinstance(value, (int, long, float)):
+            return float(value)
+        if isinstance(value, basestring) and self.name in self.METRICS:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+        return None
+
+    def start(self, value):
+        if self.number(value) is not None:
+            self.kind = 'numeric'
+            self.data = array('d', [float('nan')] * self.nulls)
+        elif isinstance(value, basestring):
+            self.kind = 'string'
+            self.data = array('i', [-1] * self.nulls)
+        else:
+            self.kind = 'object'
+            self.data = [None] * self.nulls
+
+    def append(self, value):
+        if self.is_id and isinstance(value, (int, long)) and \
+                not isinstance(value, bool):
+            # A numeric ID is kept as the string the API uses for it
+            value = str(value)
+        if self.data is None:
+            if value is None:
+                self.nulls += 1
+                return
+            self.start(value)
+        if self.kind == 'numeric':
+            number = self.number(value)
+            if number is not None or value is None:
+                self.data.append(float('nan') if value is None else number)
+                return
+        elif self.kind == 'string':
+            if value is None:
+                self.data.append(-1)
+                return
+            if isinstance(value, basestring):
+                if value not in self.index:
+                    self.index[value] = len(self.dictionary)
+                    self.dictionary.append(value)
+                self.data.append(self.index[value])
+                return
+        else:
+            self.data.append(value)
+            return
+        self.data = self.values()
+        self.kind = 'object'
+        self.data.append(value)
+
+    def values(self):
+        """Returns the column as a list of Python values."""
+        if self.data is None:
+            return [None] * self.nulls
+        if self.kind == 'numeric':
+            return [None if value != value else value for value in self.data]
+        if self.kind == 'string':
+            return [None if code < 0 else self.dictionary[code]
+                    for code in self.data]
+        return list(self.data)
+
+
+class ColumnarReport(object):
+    """
+    Report rows stored column by column, which takes far less memory than
+    a list of dicts repeating the same keys and lets columns be summed and
+    grouped without building rows. Numeric columns can be exported to
+    NumPy without copying when NumPy is installed.
+    """
+    def __init__(self, columns=None):
+        self.columns = collections.OrderedDict(
+            (name, ReportColumn(name)) for name in columns or [])
+        self.length = 0
+
+    @classmethod
+    def from_rows(cls, rows, columns=None):
+        report = cls(columns)
+        report.extend(rows)
+        return report
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        """Yields the rows as dicts again."""
+        names = self.columns.keys()
+        for values in zip(*[self.column(name) for name in names]):
+            yield dict(zip(names, values))
+
+    def append(self, row):
+        for name in row:
+            if name not in self.columns:
+                self.columns[name] = ReportColumn(name, self.length)
+        for name, column in self.columns.iteritems():
+            column.append(row.get(name))
+        self.length += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def column(self, name):
+        """Returns the values of the column as a list."""
+        return self.columns[name].values()
+
+    def to_numpy(self, name):
+        """
+        Returns the column as a NumPy array. Numeric columns, with NaN for
+        nulls, and the codes of string columns share the memory of the
+        column; other columns are copied into an object array.
+        """
+        if numpy is None:
+            raise ImportError('NumPy is required to export columns')
+        column = self.columns[name]
+        if column.kind == 'numeric':
+            return numpy.frombuffer(column.data, dtype=numpy.float64)
+        if column.kind == 'string':
+            return numpy.frombuffer(column.data, dtype=numpy.intc)
+        return numpy.array(column.values(), dtype=object)
+
+    def sum(self, name):
+        """Returns the sum of a numeric column, skipping nulls."""
+        column = self.columns[name]
+        if column.kind != 'numeric':
+            return 0.0
+        if numpy is not None:
+            return float(numpy.nansum(self.to_numpy(name)))
+        return math.fsum(value for value in column.data if value == value)
+
+    def group_by(self, keys, metrics=()):
+        """
+        Returns the sums of the metrics columns for each distinct value of
+        the keys columns, as {key: {metric: sum}}; with several keys, each
+        key is a tuple of their values.
+        """
+        if isinstance(keys, basestring):
+            keys = [keys]
+        if numpy is not None and all(
+                self.columns[key].kind == 'string' for key in keys):
+            return self.group_by_codes(keys, metrics)
+        key_columns = [self.column(key) for key in keys]
+        groups = zip(*key_columns) if len(keys) > 1 else key_columns[0]
+        result = dict((group, dict.fromkeys(metrics, 0.0))
+                      for group in groups)
+        for metric in metrics:
+            column = self.columns[metric]
+            values = column.data if column.kind == 'numeric' else \
+                [float('nan')] * self.length
+            for group, value in zip(groups, values):
+                if value == value:
+                    result[group][metric] += value
+        return result
+
+    def group_by_codes(self, keys, metrics):
+        """Groups on the codes of dictionary-encoded columns with NumPy."""
+        columns = [self.columns[key] for key in keys]
+        combined = numpy.zeros(self.length, dtype=numpy.int64)
+        for column in columns:
+            combined *= len(column.dictionary) + 1
+            combined += self.to_numpy(column.name) + 1
+        groups, inverse = numpy.unique(combined, return_inverse=True)
+        sums = {}
+        for metric in metrics:
+            if self.columns[metric].kind == 'numeric':
+                weights = numpy.nan_to_num(self.to_numpy(metric))
+                sums[metric] = numpy.bincount(
+                    inverse, weights=weights, minlength=len(groups))
+            else:
+                sums[metric] = numpy.zeros(len(groups))
+        result = {}
+        for i, group in enumerate(groups.tolist()):
+            values = []
+            for column in reversed(columns):
+                group, code = divmod(group, len(column.dictionary) + 1)
+                values.append(column.dictionary[code - 1] if code else None)
+            values.reverse()
+            key = tuple(values) if len(keys) > 1 else values[0]
+            result[key] = dict(
+                (metric, float(sums[metric][i])) for metric in metrics)
+        return result
+
 
 class AdsAPIError(Exception):
     """
@@ -73,7 +1567,18 @@ class AdsAPIError(Exception):
     https://developers.facebook.com/docs/reference/ads-api/error-reference/
     """
     def __init__(self, error):
-        data = json.load(error)
+        # error is either a file-like JSON response or its decoded dict
+        if isinstance(error, dict):
+            data = error
+        else:
+            body = error.read()
+            try:
+                data = json.loads(body)
+            except ValueError:
+                data = {'error': {'message': body or str(error), 'code': None,
+                                  'type': error.__class__.__name__}}
+        # The HTTP status, if the error came from an HTTP response
+        self.status = getattr(error, 'code', None)
         self.error = data
         self.message = data['error']['message']
         self.code = data['error']['code']
@@ -83,16 +1588,660 @@ class AdsAPIError(Exception):
         return '(%s %s) %s' % (self.type, self.code, self.message)
 
 
+MapResult = collections.namedtuple('MapResult', ['args', 'result', 'error'])
+
+
+class VideoUploadSession(object):
+    """
+    A resumable chunked video upload going through the start, transfer
+    and finish phases. Chunks are sent several at a time and each one is
+    retried on its own; acknowledged chunks are never sent again, so
+    calling upload() after a failure resumes from where it stopped.
+    """
+    def __init__(self, api, page_id, source, access_token, args=None,
+                 files=None, workers=4, max_attempts=3):
+        self.api = api
+        self.path = '%s/videos' % page_id
+        self.source = source
+        self.access_token = access_token
+        self.args = args or {}
+        self.files = files or {}
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base = source.tell()
+        self.file_size = file_size(source)
+        self.session_id = None
+        self.video_id = None
+        self.chunk_size = None
+        self.acknowledged = set()
+        self._lock = threading.Lock()
+
+    def request(self, args, files=None):
+        args = dict(args, access_token=self.access_token)
+        response = self.api.make_request(self.path, 'POST', args, files)
+        if response is None:
+            raise urllib2.URLError('no response for %s' % args)
+        return response
+
+    def start(self):
+        """Opens the upload session and learns the chunk size."""
+        response = self.request({
+            'upload_phase': 'start',
+            'file_size': self.file_size,
+        })
+        self.session_id = response['upload_session_id']
+        self.video_id = response['video_id']
+        start = int(response['start_offset'])
+        end = int(response['end_offset'])
+        self.chunk_size = end - start or self.file_size
+        return response
+
+    @property
+    def pending(self):
+        """Returns the offsets of the chunks that are yet to be sent."""
+        return [offset for offset in xrange(0, self.file_size, self.chunk_size)
+                if offset not in self.acknowledged]
+
+    def transfer_chunk(self, offset):
+        """Sends the chunk starting at offset, retrying it on failure."""
+        length = min(self.chunk_size, self.file_size - offset)
+        chunk = FileSlice(self.source, self.base + offset, length, self._lock)
+        args = {
+            'upload_phase': 'transfer',
+            'upload_session_id': self.session_id,
+            'start_offset': offset,
+        }
+        for attempt in xrange(1, self.max_attempts + 1):
+            try:
+                response = self.request(args, {'video_file_chunk': chunk})
+            except (AdsAPIError, urllib2.URLError) as e:
+                logger.warning('Chunk at %s of %s failed (attempt %d): %s',
+                               offset, self.video_id, attempt, e)
+                if attempt == self.max_attempts:
+                    return e
+                continue
+            self.acknowledged.add(offset)
+            return response
+
+    def transfer(self):
+        """Sends all pending chunks, several at a time."""
+        results = concurrent_map(self.transfer_chunk, self.pending,
+                                 self.workers)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+    def finish(self):
+        """Closes the upload session and publishes the video."""
+        args = dict(self.args, upload_phase='finish',
+                    upload_session_id=self.session_id)
+        return self.request(args, self.files)
+
+    def upload(self):
+        """Runs, or resumes, the whole upload."""
+        if self.session_id is None:
+            self.start()
+        self.transfer()
+        return self.finish()
+
+
+class ReportJob(object):
+    """An asynchronous report job and the progress it last reported."""
+    def __init__(self, account_id, args):
+        self.account_id = account_id
+        self.args = args
+        self.job_id = None
+        self.status = None
+        self.percent = 0
+        self.started = None
+        self.result = None
+        self.error = None
+
+    @property
+    def done(self):
+        return self.result is not None or self.error is not None
+
+    def update(self, response):
+        self.status = response.get('async_status')
+        self.percent = float(response.get('async_percent_completion') or 0)
+        if self.started is None:
+            self.started = (time.time(), self.percent)
+
+    def remaining(self):
+        """Returns the estimated seconds left, or None if unknown."""
+        if self.started is None:
+            return None
+        elapsed = time.time() - self.started[0]
+        progress = self.percent - self.started[1]
+        if elapsed <= 0 or progress <= 0:
+            return None
+        return (100 - self.percent) * elapsed / progress
+
+
+class ReportJobManager(object):
+    """
+    Runs many asynchronous report jobs at once. Jobs are started in
+    batches, their statuses are polled together in batch requests, and
+    the result of each job is fetched as soon as it completes. The poll
+    interval follows the progress the jobs report, between min_interval
+    and max_interval seconds.
+    """
+    COMPLETED = 'Job Completed'
+    FAILED = ('Job Failed', 'Job Skipped')
+
+    def __init__(self, api, min_interval=1, max_interval=60):
+        self.api = api
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.jobs = []
+
+    def submit(self, account_id, data_columns, **kwargs):
+        """
+        Queues a job taking the arguments of get_adreport_stats2, and
+        returns its ReportJob.
+        """
+        kwargs.update(account_id=account_id, data_columns=data_columns)
+        job = ReportJob(account_id, kwargs)
+        self.jobs.append(job)
+        return job
+
+    def start(self):
+        """Starts all queued jobs in batch requests."""
+        jobs = [job for job in self.jobs
+                if job.job_id is None and not job.done]
+        if not jobs:
+            return
+        batch = [self.api.get_adreport_stats2(async=True, batch=True,
+                                              **job.args) for job in jobs]
+        for job, response in zip(jobs, self.responses(batch)):
+            if isinstance(response, Exception):
+                job.error = response
+                continue
+            if isinstance(response, dict):
+                response = response.get('report_run_id', response.get('id'))
+            job.job_id = response
+
+    def responses(self, batch):
+        """Returns the responses to batch, turning errors into exceptions."""
+        responses = self.api.make_batch_request(batch)
+        if not isinstance(responses, list):
+            responses = [responses] * len(batch)
+        for idx, response in enumerate(responses):
+            if response is None:
+                responses[idx] = urllib2.URLError('no response')
+            elif isinstance(response, dict) and 'error' in response:
+                responses[idx] = AdsAPIError(response)
+        return responses
+
+    def poll(self, jobs):
+        """Updates the status of the jobs, returning those that finished."""
+        batch = [self.api.get_async_job_status(job.job_id, batch=True)
+                 for job in jobs]
+        finished = []
+        for job, response in zip(jobs, self.responses(batch)):
+            if isinstance(response, Exception):
+                job.error = response
+                finished.append(job)
+                continue
+            job.update(response)
+            if job.status == self.COMPLETED:
+                finished.append(job)
+            elif job.status in self.FAILED:
+                job.error = AdsAPIError({'error': {
+                    'message': '%s: %s' % (job.job_id, job.status),
+                    'code': None, 'type': 'ReportJobError'}})
+                finished.append(job)
+        return finished
+
+    def fetch(self, jobs):
+        """Fetches the results of completed jobs."""
+        jobs = [job for job in jobs if job.error is None]
+        if not jobs:
+            return
+        batch = [self.api.get_async_job_result(job.account_id, job.job_id,
+                                               batch=True) for job in jobs]
+        for job, response in zip(jobs, self.responses(batch)):
+            if isinstance(response, Exception):
+                job.error = response
+            else:
+                job.result = response
+
+    def next_interval(self, jobs):
+        """Returns how long to wait before polling the jobs again."""
+        estimates = [job.remaining() for job in jobs]
+        estimates = [estimate for estimate in estimates
+                     if estimate is not None]
+        if estimates:
+            self.interval = min(estimates)
+        else:
+            self.interval *= 1.5
+        self.interval = max(self.min_interval,
+                            min(self.max_interval, self.interval))
+        return self.interval
+
+    def as_completed(self):
+        """
+        Starts the queued jobs and yields each one as soon as it has
+        finished, with its result, or its error if it failed.
+        """
+        pending = [job for job in self.jobs if not job.done]
+        self.start()
+        running = []
+        for job in pending:
+            if job.done:
+                yield job
+            else:
+                running.append(job)
+        while running:
+            finished = self.poll(running)
+            self.fetch(finished)
+            for job in finished:
+                running.remove(job)
+                yield job
+            if running:
+                time.sleep(self.next_interval(running))
+
+
+class ReportSync(object):
+    """
+    Keeps the daily rows of reports in a local SQLite database, so that a
+    sync only fetches days it has never fetched, and days still inside the
+    trailing window of trailing_days when they were last fetched, during
+    which the API may still revise them for attribution. Reports are keyed
+    by account, data_columns, filters and actions_group_by.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS watermarks (
+            report TEXT, day TEXT, fetched_on TEXT,
+            PRIMARY KEY (report, day));
+        CREATE TABLE IF NOT EXISTS rows (
+            report TEXT, day TEXT, seq INTEGER, data TEXT,
+            PRIMARY KEY (report, day, seq));
+    """
+
+    def __init__(self, api, path=':memory:', trailing_days=3):
+        self.api = api
+        self.trailing_days = trailing_days
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def key(self, account_id, data_columns, filters=None,
+            actions_group_by=None):
+        """Returns the key of a report in the store."""
+        key = [str(account_id), data_columns, filters]
+        # Keeps the keys of reports without actions_group_by as they were
+        if actions_group_by:
+            key.append(actions_group_by)
+        return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+    def stale_days(self, report, date_start, date_end, today):
+        """
+        Returns the days of the range that need to be fetched, leaving out
+        those after today, which have no data yet.
+        """
+        fetched = dict(self.db.execute(
+            'SELECT day, fetched_on FROM watermarks WHERE report = ?',
+            (report,)))
+        today = today.strftime('%Y-%m-%d')
+        days = []
+        for day, _ in time_windows(date_start, date_end, 1):
+            if day.strftime('%Y-%m-%d') > today:
+                break
+            fetched_on = fetched.get(day.strftime('%Y-%m-%d'))
+            settled = day + datetime.timedelta(self.trailing_days)
+            if fetched_on is None or \
+                    fetched_on < settled.strftime('%Y-%m-%d'):
+                days.append(day)
+        return days
+
+    def sync(self, account_id, data_columns, date_start, date_end,
+             filters=None, actions_group_by=None, today=None):
+        """
+        Fetches the stale days of the range from date_start to date_end,
+        a day per window, and returns how many days were fetched.
+        """
+        report = self.key(account_id, data_columns, filters,
+                          actions_group_by)
+        today = today or datetime.datetime.today()
+        fetched_on = today.strftime('%Y-%m-%d')
+        days = self.stale_days(report, date_start, date_end, today)
+        # Fetch each run of consecutive stale days together
+        runs = []
+        for day in days:
+            if runs and runs[-1][1] + datetime.timedelta(1) == day:
+                runs[-1][1] = day
+            else:
+                runs.append([day, day])
+        for start, end in runs:
+            for day, _, rows in self.api.iter_adreport_stats2_windows(
+                    account_id, data_columns, start, end, 'day',
+                    actions_group_by=actions_group_by, filters=filters):
+                day = day.strftime('%Y-%m-%d')
+                with self.db:
+                    self.db.execute(
+                        'DELETE FROM rows WHERE report = ? AND day = ?',
+                        (report, day))
+                    self.db.executemany(
+                        'INSERT INTO rows VALUES (?, ?, ?, ?)',
+                        [(report, day, seq, json.dumps(row))
+                         for seq, row in enumerate(rows)])
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?)',
+                        (report, day, fetched_on))
+        return len(days)
+
+    def rows(self, account_id, data_columns, date_start, date_end,
+             filters=None, actions_group_by=None):
+        """Yields the stored rows of the range in time order."""
+        cursor = self.db.execute(
+            'SELECT data FROM rows WHERE report = ? AND day BETWEEN ? AND ? '
+            'ORDER BY day, seq',
+            (self.key(account_id, data_columns, filters, actions_group_by),
+             date_start.strftime('%Y-%m-%d'), date_end.strftime('%Y-%m-%d')))
+        for (data,) in cursor:
+            yield json.loads(data)
+
+
+def file_md5(filename, chunk_size=64 * 1024):
+    """Returns the MD5 hex digest of a file, which is its ad image hash."""
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class ImageUploader(object):
+    """
+    Uploads ad images to each account at most once. Images are known by
+    the MD5 hash of their contents, which the API uses as the image hash.
+    Hashes that a local SQLite index records for the account, or that
+    get_adimages finds there, are skipped, and the other images are
+    uploaded files_per_request at a time in concurrent requests.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS images (
+            account TEXT, hash TEXT, PRIMARY KEY (account, hash));
+    """
+    HASHES_PER_REQUEST = 50
+
+    def __init__(self, api, path=':memory:', files_per_request=10,
+                 workers=None):
+        self.api = api
+        self.files_per_request = files_per_request
+        self.workers = workers or api.batch_workers
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+        self.lock = threading.Lock()
+        # Hashes of the files seen, by path, size and modification time
+        self.hashes = {}
+
+    def close(self):
+        self.db.close()
+
+    def hash(self, filename):
+        """Returns the image hash of a file, hashing it only once."""
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+        if key not in self.hashes:
+            self.hashes[key] = file_md5(filename)
+        return self.hashes[key]
+
+    def known(self, account_id, hashes):
+        """Returns those of the hashes the index has for the account."""
+        with self.lock:
+            return set(row[0] for row in self.db.execute(
+                'SELECT hash FROM images WHERE account = ?',
+                (str(account_id),)) if row[0] in hashes)
+
+    def record(self, account_id, hashes):
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO images VALUES (?, ?)',
+                [(str(account_id), image_hash) for image_hash in hashes])
+
+    def upload(self, account_id, filenames):
+        """
+        Makes sure the account has the images of the files, and returns
+        the image hash of each file.
+        """
+        hashes = dict((filename, self.hash(filename))
+                      for filename in filenames)
+        unique = set(hashes.values())
+        missing = sorted(unique - self.known(account_id, unique))
+        found = set()
+        for i in xrange(0, len(missing), self.HASHES_PER_REQUEST):
+            chunk = missing[i:i + self.HASHES_PER_REQUEST]
+            for image in self.api.iter_adimages(account_id, json.dumps(chunk)):
+                found.add(image.get('hash'))
+        self.record(account_id, found & unique)
+        files = {}
+        for filename, image_hash in sorted(hashes.items()):
+            if image_hash in missing and image_hash not in found:
+                files.setdefault(image_hash, filename)
+        files = sorted(files.items())
+        groups = [files[i:i + self.files_per_request]
+                  for i in xrange(0, len(files), self.files_per_request)]
+        concurrent_map(lambda group: self.upload_group(account_id, group),
+                       groups, self.workers)
+        return hashes
+
+    def upload_group(self, account_id, group):
+        """Uploads (hash, filename) images in a single request."""
+        opened = {}
+        try:
+            for image_hash, filename in group:
+                name = image_hash + os.path.splitext(filename)[1]
+                opened[name] = open(filename, 'rb')
+            response = self.api.create_adimages(account_id, opened)
+        finally:
+            for f in opened.values():
+                f.close()
+        if response is None:
+            raise urllib2.URLError('no response for %s' % account_id)
+        self.record(account_id, [image['hash'] for image in
+                                 response.get('images', {}).values()])
+
+
+def normalize_email(value):
+    return value.strip().lower()
+
+
+def normalize_phone(value):
+    """Keeps the digits of a phone number, without leading zeros."""
+    return re.sub(r'\D', '', value).lstrip('0')
+
+
+AUDIENCE_SCHEMAS = {
+    'EMAIL_SHA256': normalize_email,
+    'PHONE_SHA256': normalize_phone,
+}
+
+
+def hash_members(schema, values):
+    """
+    Returns the SHA-256 hex digests of the values normalized for schema,
+    leaving out those that are empty once normalized.
+    """
+    normalize = AUDIENCE_SCHEMAS[schema]
+    hashes = []
+    for value in values:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        value = normalize(value)
+        if value:
+            hashes.append(hashlib.sha256(value).hexdigest())
+    return hashes
+
+
+class AudienceUploader(object):
+    """
+    Uploads the members of a custom audience from a file of one identifier
+    per line, or from any iterable of them. Chunks of chunk_size members
+    are normalized and hashed on a pool of processes, unless processes is
+    0, and uploaded by workers threads; at most in_flight chunks are held
+    at once, so memory does not grow with the input. Chunks are
+    acknowledged in order, and progress, if given, is called with the
+    number of chunks and of input rows acknowledged so far; after a
+    failure, pass acknowledged as resume_from to carry on from there.
+    """
+    CHUNK_SIZE = 10000
+
+    def __init__(self, api, audience_id, schema='EMAIL_SHA256',
+                 chunk_size=CHUNK_SIZE, processes=None, workers=None,
+                 in_flight=None, progress=None):
+        if schema not in AUDIENCE_SCHEMAS:
+            raise ValueError('Unknown audience schema %s' % schema)
+        self.api = api
+        self.audience_id = audience_id
+        self.schema = schema
+        self.chunk_size = chunk_size
+        self.processes = processes
+        self.workers = workers or api.batch_workers
+        self.in_flight = in_flight or 2 * self.workers
+        self.progress = progress
+        self.acknowledged = 0
+        self.rows = 0
+
+    def chunks(self, source, start=0):
+        """Yields (index, values) for the chunks of source from start."""
+        if isinstance(source, basestring):
+            with open(source) as f:
+                for chunk in self.chunks(f, start):
+                    yield chunk
+            return
+        values = (value.rstrip('\r\n') for value in source)
+        index = 0
+        while True:
+            chunk = list(itertools.islice(values, self.chunk_size))
+            if not chunk:
+                return
+            if index >= start:
+                yield index, chunk
+            index += 1
+
+    def upload_chunk(self, pool, values):
+        """Hashes the values and uploads them, returning their count."""
+        if pool is None:
+            hashes = hash_members(self.schema, values)
+        else:
+            hashes = pool.apply(hash_members, (self.schema, values))
+        if hashes:
+            response = self.api.add_custom_audience_members(
+                self.audience_id, self.schema, hashes)
+            if response is None:
+                raise urllib2.URLError('no response for %s' %
+                                       self.audience_id)
+        return len(values)
+
+    def upload(self, source, resume_from=0):
+        """
+        Uploads the chunks of source from resume_from on, and returns the
+        number of chunks acknowledged.
+        """
+        self.acknowledged = resume_from
+        pool = None
+        if self.processes != 0:
+            pool = multiprocessing.Pool(self.processes)
+        uploads = ThreadPool(self.workers)
+        window = collections.deque()
+        try:
+            for index, values in self.chunks(source, resume_from):
+                if len(window) >= self.in_flight:
+                    self.acknowledge(window.popleft())
+                window.append(uploads.apply_async(
+                    self.upload_chunk, (pool, values)))
+            while window:
+                self.acknowledge(window.popleft())
+        finally:
+            uploads.close()
+            uploads.join()
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return self.acknowledged
+
+    def acknowledge(self, result):
+        """Waits for the oldest chunk in flight, raising its error."""
+        self.rows += result.get()
+        self.acknowledged += 1
+        if self.progress is not None:
+            self.progress(self.acknowledged, self.rows)
+
+
 class AdsAPI(object):
     """A client for the Facebook Ads API."""
     DATA_LIMIT = 100
+    BATCH_LIMIT = 50
+    COMPRESS_MIN_SIZE = 1024
 
-    def __init__(self, access_token, app_id, app_secret):
+    def __init__(self, access_token, app_id, app_secret, pool_size=10,
+                 timeout=None, idle_timeout=60, batch_workers=4, cache=None,
+                 rate_limiter=None, retry_policy=None, coalesce=True,
+                 compress_requests=False, metrics=None, transport=None):
         self.access_token = access_token
         self.app_id = app_id
         self.app_secret = app_secret
         h = hmac.new(access_token, app_secret, hashlib.sha256)
         self.appsecret_proof = h.hexdigest()
+        # By default, requests go over a pool of keep-alive connections
+        self.transport = transport or PooledTransport(
+            ConnectionPool(pool_size, timeout, idle_timeout))
+        self.pool = getattr(self.transport, 'pool', None)
+        self.batch_workers = batch_workers
+        # Pass True or a ResponseCache to cache GET responses
+        self.cache = ResponseCache() if cache is True else cache
+        self.page_tokens = PageTokenCache()
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.in_flight = SingleFlight() if coalesce else None
+        # Only for endpoints known to accept gzipped request bodies
+        self.compress_requests = compress_requests
+        # Pass True or a Metrics to record per-endpoint request metrics
+        self.metrics = Metrics() if metrics is True else metrics
+
+    def urlopen(self, method, url, body=None, headers=None):
+        """
+        Opens the given url through the transport, accepting
+        a compressed response that is decompressed as it is read. With
+        compress_requests, form bodies of COMPRESS_MIN_SIZE bytes or more
+        are sent gzipped.
+        """
+        headers = dict(headers or {})
+        headers['Accept-Encoding'] = 'gzip, deflate'
+        if body is not None:
+            headers.setdefault(
+                'Content-Type', 'application/x-www-form-urlencoded')
+            if self.compress_requests and isinstance(body, str) and \
+                    len(body) >= self.COMPRESS_MIN_SIZE:
+                body = gzip_compress(body)
+                headers['Content-Encoding'] = 'gzip'
+        f = self.transport.send(method, url, headers, body)
+        code = f.getcode()
+        if code >= 400:
+            try:
+                data = decode_response(f).read()
+            finally:
+                f.close()
+            raise urllib2.HTTPError(url, code, getattr(f, 'msg', ''),
+                                    f.info(), io.BytesIO(data))
+        return decode_response(f)
+
+    def close(self):
+        """Closes the connections of the transport."""
+        self.transport.close()
+
+    def rate_limit_keys(self, path):
+        """Returns the rate limiter keys of a request to path."""
+        keys = [('app', self.app_id), ('token', self.appsecret_proof)]
+        match = re.match(r'act_(\d+)', path)
+        if match:
+            keys.append(('account', match.group(1)))
+        return keys
 
     def make_request(self, path, method, args=None, files=None, batch=False):
         """Makes a request against the Facebook Ads API endpoint."""
@@ -100,85 +2249,523 @@ class AdsAPI(object):
 
         if batch:
             # Then just return a dict for the batch request
+            query = unescape_references(urllib.urlencode(args))
             return {
                 'method': method,
-                'relative_url': '%s?%s' % (path, urllib.urlencode(args))
+                'relative_url': '%s?%s' % (path, query)
             }
-        logger.info('Making a %s request at %s with %s' % (method, path, args))
+        if self.cache is not None and method == 'GET':
+            response = self.cache.get(path, args)
+            if self.metrics is not None:
+                self.metrics.cache(path, response is not None)
+            if response is not None:
+                return response
+        logger.info('Making a %s request at %s with %s',
+                    method, path, redact(args))
         if 'access_token' not in args:
             args['access_token'] = self.access_token
+
+        def send():
+            return self.with_retries(
+                method, path,
+                lambda: self.send_request(path, method, args, files), files)
+        try:
+            if self.in_flight is not None and method == 'GET':
+                # Identical GETs in flight share a single request
+                key = ResponseCache.key(path, args), args['access_token']
+                response = self.in_flight.do(key, send)
+            else:
+                response = send()
+        except urllib2.URLError as e:
+            logger.warning('Giving up on a %s request at %s: %s',
+                           method, path, e.reason)
+            return None
+        finally:
+            if self.cache is not None and method != 'GET':
+                self.cache.invalidate(path)
+        if self.cache is not None and method == 'GET':
+            self.cache.set(path, args, response)
+        return response
+
+    def with_retries(self, method, path, send, files=None):
+        """
+        Calls send() until it succeeds, or until the retry policy gives up
+        and its last AdsAPIError or urllib2.URLError is raised. Files are
+        rewound before each retry.
+        """
+        offsets = [(f, f.tell()) for f in (files or {}).values()]
+        start = time.time()
+        attempt = 1
+        while True:
+            try:
+                return send()
+            except (AdsAPIError, urllib2.URLError) as e:
+                delay = None
+                if self.retry_policy.retryable(
+                        method, getattr(e, 'status', None),
+                        getattr(e, 'code', None)):
+                    delay = self.retry_policy.delay(attempt, start)
+                if delay is None:
+                    raise
+            logger.warning('Retrying a %s request at %s in %.2fs: %s',
+                           method, path, delay, e)
+            time.sleep(delay)
+            attempt += 1
+            for f, offset in offsets:
+                f.seek(offset)
+
+    def send_request(self, path, method, args, files=None, stream=False):
+        """
+        Sends a single request and returns its decoded response, or the
+        open response itself with stream. Raises AdsAPIError for error
+        responses and urllib2.URLError when the API could not be reached.
+        """
+        keys = self.rate_limit_keys(path)
+        self.rate_limiter.acquire(keys)
+        start = time.time()
+        sent = 0
         try:
             if method == 'GET':
                 url = '%s/%s?%s' % (FACEBOOK_API, path, urllib.urlencode(args))
-                f = urllib2.urlopen(url)
+                sent = len(url)
+                f = self.urlopen('GET', url)
             elif method == 'POST':
                 url = '%s/%s' % (FACEBOOK_API, path)
                 if files:
                     encoder = MultipartFormdataEncoder()
-                    content_type, body = encoder.encode(args, files)
-                    req = urllib2.Request(url, data=body)
-                    req.add_header('Content-Type', content_type)
-                    f = urllib2.urlopen(req)
+                    content_type, body = encoder.stream(args, files)
+                    sent = len(url) + len(body)
+                    f = self.urlopen('POST', url, body, {
+                        'Content-Type': content_type,
+                        'Content-Length': str(len(body)),
+                    })
                 else:
-                    f = urllib2.urlopen(url, urllib.urlencode(args))
+                    body = urllib.urlencode(args)
+                    sent = len(url) + len(body)
+                    f = self.urlopen('POST', url, body)
             elif method == 'DELETE':
                 url = '%s/%s?%s' % (FACEBOOK_API, path, urllib.urlencode(args))
-                req = urllib2.Request(url)
-                req.get_method = lambda: 'DELETE'
-                f = urllib2.urlopen(req)
+                sent = len(url)
+                f = self.urlopen('DELETE', url)
             else:
                 raise
-            return json.load(f)
+            self.rate_limiter.update(keys, f.info())
+            response = f if stream else json.load(f)
+            if self.metrics is not None:
+                self.metrics.observe(path, time.time() - start, sent,
+                                     content_length(f.info()))
+            return response
         except urllib2.HTTPError as e:
-            print '%s' % e
-            raise AdsAPIError(e)
-        except urllib2.URLError as e:
-            print 'URLError: %s' % e.reason
+            logger.debug('%s request at %s failed: %s', method, path, e)
+            error = AdsAPIError(e)
+            self.rate_limiter.update(keys, e.info(), error.code)
+            if self.metrics is not None:
+                self.metrics.observe(path, time.time() - start, sent,
+                                     content_length(e.info()))
+                self.metrics.error(path, error.code)
+            raise error
+        except urllib2.URLError:
+            if self.metrics is not None:
+                self.metrics.observe(path, time.time() - start, sent)
+                self.metrics.error(path, 'URLError')
+            raise
+
+    def iter_rows(self, path, args=None, key='data'):
+        """
+        Yields the objects of the key array of GET responses one at a time
+        as they are parsed off the socket, following paging, so that memory
+        use scales with the size of a row rather than of the response.
+        """
+        args = dict(args or {})
+        if 'access_token' not in args:
+            args['access_token'] = self.access_token
+        request = (path, 'GET', args)
+        while request:
+            path, method, args = request
+            f = self.with_retries(
+                method, path,
+                lambda: self.send_request(path, method, args, stream=True))
+            page = {}
+            try:
+                for row in iter_json_array(f, key, page):
+                    yield row
+            finally:
+                f.close()
+            request = self.next_page_request(path, args, page)
+
+    def make_batch_request(self, batch, lazy=False):
+        """
+        Makes a batched request against the Facebook Ads API endpoint.
+        Batches over BATCH_LIMIT operations are split into sub-batches that
+        are sent concurrently; the results keep the original order, and the
+        error of a failed sub-batch is reported for each of its operations.
+        With a cache, GET operations are answered from it when possible.
+        Identical GET operations are sent once and share the response.
+        With lazy, a LazyBatchResponse that decodes each body only when it
+        is accessed is returned instead, and the cache is not read, though
+        writes still invalidate it.
+        """
+        batch = list(batch)
+        if not lazy:
+            keys = [self.batch_key(request) for request in batch]
+            firsts = {}
+            for idx, key in enumerate(keys):
+                if key is not None:
+                    firsts.setdefault(key, idx)
+            if len(firsts) < len(keys) - keys.count(None):
+                return self.make_deduplicated_batch_request(
+                    batch, keys, firsts)
+        if self.cache is None:
+            return self.retry_batch(batch, lazy)
+        if lazy:
+            responses = self.retry_batch(batch, lazy)
+            for request in batch:
+                if request['method'] != 'GET':
+                    self.cache.invalidate(
+                        parse_relative_url(request['relative_url'])[0])
+            return responses
+        data = [None] * len(batch)
+        for idx, request in enumerate(batch):
+            if request['method'] == 'GET' and not is_dependent(request):
+                data[idx] = self.cache.get(
+                    *parse_relative_url(request['relative_url']))
+                if self.metrics is not None:
+                    self.metrics.cache(request['relative_url'],
+                                       data[idx] is not None)
+        misses = [idx for idx, val in enumerate(data) if val is None]
+        if misses:
+            responses = self.retry_batch([batch[idx] for idx in misses])
+            if not isinstance(responses, list):
+                return responses
+            for idx, response in zip(misses, responses):
+                data[idx] = response
+                path, args = parse_relative_url(batch[idx]['relative_url'])
+                if batch[idx]['method'] != 'GET':
+                    self.cache.invalidate(path)
+                elif not is_dependent(batch[idx]):
+                    self.cache.set(path, args, response)
+        # For debugging
+        self.data = data
+        return data
+
+    def batch_key(self, request):
+        """Returns what identical GET operations of a batch share, if any."""
+        if request['method'] != 'GET' or is_dependent(request):
+            return None
+        path, args = parse_relative_url(request['relative_url'])
+        return ResponseCache.key(path, args), args.get('access_token')
+
+    def make_deduplicated_batch_request(self, batch, keys, firsts):
+        """
+        Sends only the first of each set of identical GET operations of the
+        batch, given their keys and the index of the first of each, and
+        answers the others with copies of its response.
+        """
+        sent = [idx for idx, key in enumerate(keys)
+                if key is None or firsts[key] == idx]
+        responses = self.make_batch_request([batch[idx] for idx in sent])
+        if not isinstance(responses, list):
+            return responses
+        data = [None] * len(batch)
+        for idx, response in zip(sent, responses):
+            data[idx] = response
+        for idx, key in enumerate(keys):
+            if key is not None and firsts[key] != idx:
+                data[idx] = copy.deepcopy(data[firsts[key]])
+        # For debugging
+        self.data = data
+        return data
+
+    def retry_batch(self, batch, lazy=False):
+        """
+        Dispatches the batch, then resends only the failed operations that
+        the retry policy allows, never the whole batch. Operations that are
+        named or refer to others are not resent on their own.
+        """
+        data = self.dispatch_batch(batch, lazy)
+        whole = not isinstance(data, (list, LazyBatchResponse))
+        if whole:
+            data = [data] * len(batch)
+        # Successful lazy responses need not be decoded to be checked
+        ok = getattr(data, 'ok', lambda idx: False)
+        start = time.time()
+        attempt = 1
+        while True:
+            failed = [idx for idx in xrange(len(data)) if not ok(idx) and
+                      self.retryable_operation(batch[idx], data[idx])]
+            if not failed:
+                break
+            delay = self.retry_policy.delay(attempt, start)
+            if delay is None:
+                break
+            logger.warning('Retrying %d of %d batched requests in %.2fs',
+                           len(failed), len(batch), delay)
+            time.sleep(delay)
+            attempt += 1
+            responses = self.dispatch_batch([batch[idx] for idx in failed])
+            if not isinstance(responses, list):
+                responses = [responses] * len(failed)
+            else:
+                whole = False
+            for idx, response in zip(failed, responses):
+                data[idx] = response
+        if whole:
+            # Nothing got through; report the error of the batch as before
+            if data[0] is None:
+                logger.warning('Giving up on a batch of %d requests',
+                               len(batch))
+            return data[0]
+        return data
+
+    def retryable_operation(self, request, response):
+        """Returns whether a batch operation failed in a retryable way."""
+        if is_dependent(request):
+            return False
+        if response is None:
+            return self.retry_policy.retryable(request['method'])
+        if isinstance(response, dict) and 'error' in response:
+            return self.retry_policy.retryable(
+                request['method'], code=response['error'].get('code'))
+        return False
+
+    def dispatch_batch(self, batch, lazy=False):
+        """Sends the batch, split into concurrent sub-batches if needed."""
+        if len(batch) <= self.BATCH_LIMIT:
+            return self.send_batch(batch, lazy)
+        chunks = [batch[i:i + self.BATCH_LIMIT]
+                  for i in xrange(0, len(batch), self.BATCH_LIMIT)]
+        data = LazyBatchResponse([]) if lazy else []
+        results = concurrent_map(lambda chunk: self.send_batch(chunk, lazy),
+                                 chunks, self.batch_workers)
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, (list, LazyBatchResponse)):
+                data.extend(result)
+            else:
+                data.extend([result] * len(chunk))
+        # For debugging
+        self.data = data
+        return data
 
-    def make_batch_request(self, batch):
-        """Makes a batched request against the Facebook Ads API endpoint."""
+    def send_batch(self, batch, lazy=False):
+        """Sends up to BATCH_LIMIT operations in a single batched request."""
         args = {}
         args['access_token'] = self.access_token
         args['batch'] = json.dumps(batch)
-        logger.info('Making a batched request with %s' % args)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Making a batched request of %s', ', '.join(
+                '%s %s' % (request['method'],
+                           redact_url(request['relative_url']))
+                for request in batch))
+        keys = set(self.rate_limit_keys(''))
+        for request in batch:
+            keys.update(self.rate_limit_keys(request['relative_url']))
+        self.rate_limiter.acquire(keys, len(batch))
+        if self.metrics is not None:
+            self.metrics.batch(batch)
+        start = time.time()
+        body = urllib.urlencode(args)
         try:
-            f = urllib2.urlopen(FACEBOOK_API, urllib.urlencode(args))
+            f = self.urlopen('POST', FACEBOOK_API, body)
             data = json.load(f)
+            if self.metrics is not None:
+                self.metrics.observe('', time.time() - start,
+                                     len(FACEBOOK_API) + len(body),
+                                     content_length(f.info()))
             # For debugging
             self.data = data
-            for idx, val in enumerate(data):
+            if lazy:
+                data = LazyBatchResponse(data)
+            for idx, val in enumerate(data.raw if lazy else data):
+                # Operations the API did not get to come back as null
+                if val is None:
+                    continue
+                if lazy and data.ok(idx):
+                    self.update_rate_limiter(batch[idx], val, None)
+                    continue
                 data[idx] = json.loads(val['body'])
+                self.update_rate_limiter(batch[idx], val, data[idx])
+                if self.metrics is not None and \
+                        isinstance(data[idx], dict) and 'error' in data[idx]:
+                    self.metrics.error(batch[idx]['relative_url'],
+                                       data[idx]['error'].get('code'))
             return data
         except urllib2.HTTPError as e:
-            print '%s' % e
-            return json.load(e)
+            logger.debug('Batched request failed: %s', e)
+            error = AdsAPIError(e)
+            self.rate_limiter.update(keys, e.info(), error.code)
+            if self.metrics is not None:
+                self.metrics.observe('', time.time() - start,
+                                     len(FACEBOOK_API) + len(body),
+                                     content_length(e.info()))
+                self.metrics.error('', error.code)
+            return error.error
         except urllib2.URLError as e:
-            print 'URLError: %s' % e.reason
+            logger.debug('Batched request failed: %s', e.reason)
+            if self.metrics is not None:
+                self.metrics.observe('', time.time() - start,
+                                     len(FACEBOOK_API) + len(body))
+                self.metrics.error('', 'URLError')
+
+    def update_rate_limiter(self, request, val, response):
+        """Feeds the headers and error code of a batch operation back."""
+        headers = dict((header['name'], header['value'])
+                       for header in val.get('headers') or [])
+        code = None
+        if isinstance(response, dict) and 'error' in response:
+            code = response['error'].get('code')
+        self.rate_limiter.update(
+            self.rate_limit_keys(request['relative_url']), headers, code)
 
     # New API
-    def make_labeled_batch_request(self, batch):
-        """Makes a batched request with label against the Facebook Ads API."""
+    def make_labeled_batch_request(self, batch, named=False):
+        """
+        Makes a batched request with label against the Facebook Ads API.
+        With named, the labels also name the operations, so that later ones,
+        in the order of an OrderedDict, can refer to earlier ones by label.
+        """
         try:
             labels = batch.keys()
             queries = batch.values()
+            if named:
+                builder = self.batch_builder()
+                for label, query in batch.items():
+                    builder.add(query, label)
+                queries = builder.operations
             data = self.make_batch_request(queries)
             # For debugging
             self.data = data
             return dict(zip(labels, data))
         except urllib2.HTTPError as e:
-            print '%s' % e
+            logger.warning('Labeled batched request failed: %s', e)
             return json.load(e)
         except urllib2.URLError as e:
-            print 'URLError: %s' % e.reason
+            logger.warning('Labeled batched request failed: %s', e.reason)
+
+    def batch(self, size=None, max_wait=None):
+        """
+        Returns a DeferredBatch, to use as a context in which method calls
+        are batched and return futures.
+        """
+        return DeferredBatch(self, size, max_wait)
+
+    def batch_builder(self):
+        """Returns a BatchBuilder for operations that refer to each other."""
+        return BatchBuilder(self)
+
+    def iter_edge(self, path, args=None, page_size=None, prefetch=True):
+        """
+        Yields the objects of a list endpoint one at a time, following the
+        paging cursors lazily. Unless prefetch is off, the next page is
+        fetched in the background while the current one is consumed. Raises
+        urllib2.URLError if a page cannot be fetched.
+        """
+        args = dict(args or {})
+        args['limit'] = page_size or self.DATA_LIMIT
+        pool = ThreadPool(1) if prefetch else None
+        try:
+            page = self.make_request(path, 'GET', args)
+            while True:
+                # A page that could not be fetched must not pass for the end
+                if page is None:
+                    raise urllib2.URLError('no response for %s' % path)
+                request = self.next_page_request(path, args, page)
+                if request and pool:
+                    following = pool.apply_async(self.make_request, request)
+                for obj in page.get('data', []):
+                    yield obj
+                if not request:
+                    break
+                if pool:
+                    page = following.get()
+                else:
+                    page = self.make_request(*request)
+        finally:
+            if pool:
+                pool.close()
+
+    def next_page_request(self, path, args, page):
+        """Returns the (path, method, args) of the page after the given one."""
+        paging = page.get('paging', {})
+        if not paging.get('next'):
+            return None
+        after = paging.get('cursors', {}).get('after')
+        if after:
+            return path, 'GET', dict(args, after=after)
+        url = urlparse.urlsplit(paging['next'])
+        return url.path.lstrip('/'), 'GET', dict(urlparse.parse_qsl(url.query))
+
+    def map(self, method, items, workers=None, batch_size=None):
+        """
+        Calls method, an AdsAPI method or its name, once for each of items
+        (a tuple of positional arguments, or a single argument), and yields
+        a MapResult for each call as soon as it finishes. Calls to methods
+        taking batch are packed into batch requests of batch_size, at most
+        BATCH_LIMIT; a failed call sets the error of its own MapResult only.
+        """
+        if isinstance(method, basestring):
+            method = getattr(self, method)
+        workers = workers or self.batch_workers
+        batch_size = min(batch_size or self.BATCH_LIMIT, self.BATCH_LIMIT)
+        calls = [item if isinstance(item, tuple) else (item,)
+                 for item in items]
+        if 'batch' in inspect.getargspec(method).args:
+            tasks = [calls[i:i + batch_size]
+                     for i in xrange(0, len(calls), batch_size)]
+            func = lambda chunk: self.map_batch(method, chunk)
+        else:
+            tasks = calls
+            func = lambda args: [self.map_call(method, args)]
+        if not tasks:
+            return
+        pool = ThreadPool(min(workers, len(tasks)))
+        try:
+            for results in pool.imap_unordered(func, tasks):
+                for result in results:
+                    yield result
+        finally:
+            pool.close()
+
+    def map_call(self, method, args):
+        """Returns the MapResult of a single call."""
+        try:
+            return MapResult(args, method(*args), None)
+        except Exception as e:
+            return MapResult(args, None, e)
+
+    def map_batch(self, method, calls):
+        """Returns the MapResults of calls sent together as a batch."""
+        results = {}
+        batch = []
+        for idx, args in enumerate(calls):
+            try:
+                batch.append((idx, method(*args, batch=True)))
+            except Exception as e:
+                results[idx] = MapResult(args, None, e)
+        data = []
+        if batch:
+            data = self.make_batch_request(
+                [request for idx, request in batch])
+        if not isinstance(data, list):
+            data = [data] * len(batch)
+        for (idx, request), response in zip(batch, data):
+            args = calls[idx]
+            if response is None:
+                error = urllib2.URLError('no response for %s' % request)
+                results[idx] = MapResult(args, None, error)
+            elif isinstance(response, dict) and 'error' in response:
+                results[idx] = MapResult(args, None, AdsAPIError(response))
+            else:
+                results[idx] = MapResult(args, response, None)
+        return [results[idx] for idx in xrange(len(calls))]
 
-    def debug_token(self, token):
+    def debug_token(self, token, batch=False):
         """Returns debug information about the given token."""
         path = 'debug_token'
         args = {
             'input_token': token,
             'access_token': '%s|%s' % (self.app_id, self.app_secret)
         }
-        return self.make_request(path, 'GET', args)
+        return self.make_request(path, 'GET', args, batch=batch)
 
     def get_adusers(self, account_id, batch=False):
         """Returns the users of the given ad account."""
@@ -197,6 +2784,12 @@ class AdsAPI(object):
         args = {'fields': fields}
         return self.make_request(path, 'GET', args, batch=batch)
 
+    def iter_adaccounts(self, user_id, fields, page_size=None):
+        """Yields the Facebook ad accounts one at a time."""
+        path = '%s/adaccounts' % user_id
+        args = {'fields': fields}
+        return self.iter_edge(path, args, page_size)
+
     # New API
     def get_adcampaign_group(self, campaign_group_id, fields, batch=False):
         """Return the fields for the given ad campaign group."""
@@ -215,6 +2808,13 @@ class AdsAPI(object):
         }
         return self.make_request(path, 'GET', args, batch=batch)
 
+    # New API
+    def iter_adcampaign_groups(self, account_id, fields, page_size=None):
+        """Yields all ad campaign groups from the given ad account."""
+        path = 'act_%s/adcampaign_groups' % account_id
+        args = {'fields': fields}
+        return self.iter_edge(path, args, page_size)
+
     # New API
     def delete_adcampaign_group(self, campaign_group_id, batch=False):
         """Delete specific campaign group."""
@@ -236,6 +2836,14 @@ class AdsAPI(object):
         args = {'fields': fields}
         return self.make_request(path, 'GET', args, batch=batch)
 
+    # New API
+    def iter_adcampaigns_of_campaign_group(self, campaign_group_id, fields,
+                                           page_size=None):
+        """Yields all ad campaigns from the given ad campaign group."""
+        path = '%s/adcampaigns' % campaign_group_id
+        args = {'fields': fields}
+        return self.iter_edge(path, args, page_size)
+
     # New API
     def get_adcampaigns_of_account(self, account_id, fields, batch=False):
         """Returns the fields of all ad sets from the given ad account."""
@@ -243,6 +2851,14 @@ class AdsAPI(object):
         args = {'fields': fields}
         return self.make_request(path, 'GET', args, batch=batch)
 
+    # New API
+    def iter_adcampaigns_of_account(self, account_id, fields,
+                                    page_size=None):
+        """Yields all ad sets from the given ad account."""
+        path = 'act_%s/adcampaigns' % account_id
+        args = {'fields': fields}
+        return self.iter_edge(path, args, page_size)
+
     def get_adcampaigns(self, account_id, fields=None, batch=False):
         """Returns the fields of all ad sets from the given ad account."""
         return self.get_adcampaigns_of_account(account_id, fields, batch=batch)
@@ -262,6 +2878,15 @@ class AdsAPI(object):
             args['adgroup_status'] = status_fields
         return self.make_request(path, 'GET', args, batch=batch)
 
+    def iter_adgroups_by_adaccount(self, account_id, fields=None,
+                                   status_fields=None, page_size=None):
+        """Yields all ad groups from the given ad account."""
+        path = 'act_%s/adgroups' % account_id
+        args = {'fields': fields} if fields else {}
+        if status_fields:
+            args['adgroup_status'] = status_fields
+        return self.iter_edge(path, args, page_size)
+
     def get_adgroups_by_adcampaign(self, campaign_id, fields=None,
                                    status_fields=None, batch=False):
         """Returns the fields of all ad groups from the given ad campaign."""
@@ -271,6 +2896,15 @@ class AdsAPI(object):
             args['adgroup_status'] = status_fields
         return self.make_request(path, 'GET', args, batch=batch)
 
+    def iter_adgroups_by_adcampaign(self, campaign_id, fields=None,
+                                    status_fields=None, page_size=None):
+        """Yields all ad groups from the given ad campaign."""
+        path = '%s/adgroups' % campaign_id
+        args = {'fields': fields} if fields else {}
+        if status_fields:
+            args['adgroup_status'] = status_fields
+        return self.iter_edge(path, args, page_size)
+
     def get_adcreative(self, creative_id, fields, batch=False):
         """Returns the fields for the given ad creative."""
         path = '%s' % creative_id
@@ -283,6 +2917,12 @@ class AdsAPI(object):
         args = {'fields': fields}
         return self.make_request(path, 'GET', args, batch=batch)
 
+    def iter_adcreatives(self, account_id, fields, page_size=None):
+        """Yields all ad creatives from the given ad account."""
+        path = 'act_%s/adcreatives' % account_id
+        args = {'fields': fields}
+        return self.iter_edge(path, args, page_size)
+
     def get_adimages(self, account_id, hashes=None, batch=False):
         """Returns the ad images for the given ad account."""
         path = 'act_%s/adimages' % account_id
@@ -291,6 +2931,22 @@ class AdsAPI(object):
             args = {'hashes': hashes}
         return self.make_request(path, 'GET', args, batch=batch)
 
+    def create_adimages(self, account_id, files, batch=False):
+        """
+        Uploads ad images to the given ad account in a single request;
+        files maps the name of each image to its open file.
+        """
+        path = 'act_%s/adimages' % account_id
+        return self.make_request(path, 'POST', {}, files, batch=batch)
+
+    def iter_adimages(self, account_id, hashes=None, page_size=None):
+        """Yields the ad images for the given ad account."""
+        path = 'act_%s/adimages' % account_id
+        args = {}
+        if hashes is not None:
+            args = {'hashes': hashes}
+        return self.iter_edge(path, args, page_size)
+
     def get_stats_by_adaccount(self, account_id, batch=False):
         """Returns the stats for a Facebook campaign."""
         path = 'act_%s/adcampaignstats' % account_id
@@ -357,12 +3013,41 @@ class AdsAPI(object):
             args['actions_group_by'] = actions_group_by
         return self.make_request(path, 'GET', args, batch=batch)
 
+    def iter_adreport_stats(self, account_id, date_preset, time_increment,
+                            data_columns, filters=None, actions_group_by=None):
+        """Yields the ad report stats rows one at a time as they arrive."""
+        request = self.get_adreport_stats(
+            account_id, date_preset, time_increment, data_columns, filters,
+            actions_group_by, batch=True)
+        return self.iter_rows(*parse_relative_url(request['relative_url']))
+
+    def columnar_adreport_stats(self, account_id, date_preset,
+                                time_increment, data_columns, filters=None,
+                                actions_group_by=None):
+        """Returns the ad report stats for the given account as columns."""
+        return ColumnarReport.from_rows(self.iter_adreport_stats(
+            account_id, date_preset, time_increment, data_columns, filters,
+            actions_group_by), data_columns)
+
     # New API
     def get_adreport_stats2(self, account_id, data_columns, date_preset=None,
                             date_start=None, date_end=None,
                             time_increment=None, actions_group_by=None,
-                            filters=None, async=False, batch=False):
-        """Returns the ad report stats for the given account."""
+                            filters=None, async=False, batch=False,
+                            shard=None):
+        """
+        Returns the ad report stats for the given account. With shard, the
+        number of days (or 'day' or 'week') of the windows that the range
+        from date_start to date_end is split into, the windows are fetched
+        concurrently and their rows are merged in time order.
+        """
+        if shard and not async and not batch and date_start and date_end:
+            rows = []
+            for _, _, window_rows in self.iter_adreport_stats2_windows(
+                    account_id, data_columns, date_start, date_end, shard,
+                    time_increment, actions_group_by, filters):
+                rows.extend(window_rows)
+            return {'data': rows}
         if date_preset is None and date_start is None and date_end is None:
             raise BaseException("Either a date_preset or a date_start/end \
                                 must be set when requesting a stats info.")
@@ -386,6 +3071,82 @@ class AdsAPI(object):
             return self.make_request(path, 'POST', args=args, batch=batch)
         return self.make_request(path, 'GET', args=args, batch=batch)
 
+    # New API
+    def iter_adreport_stats2(self, account_id, data_columns, date_preset=None,
+                             date_start=None, date_end=None,
+                             time_increment=None, actions_group_by=None,
+                             filters=None):
+        """Yields the ad report stats rows one at a time as they arrive."""
+        request = self.get_adreport_stats2(
+            account_id, data_columns, date_preset, date_start, date_end,
+            time_increment, actions_group_by, filters, batch=True)
+        return self.iter_rows(*parse_relative_url(request['relative_url']))
+
+    # New API
+    def iter_adreport_stats2_windows(self, account_id, data_columns,
+                                     date_start, date_end, shard='week',
+                                     time_increment=None,
+                                     actions_group_by=None, filters=None):
+        """
+        Yields (date_start, date_end, rows) for the windows of shard days
+        that cover date_start to date_end, in time order. The windows are
+        sent as one batch, split into concurrent sub-batches, and further
+        pages of their rows are followed afterwards. A window that gets no
+        response or an error the retry policy accepts is split in two and
+        fetched again; other errors, and such failures of a single day, are
+        raised.
+        """
+        days = {'day': 1, 'week': 7}.get(shard, shard)
+        windows = [[start, end, None]
+                   for start, end in time_windows(date_start, date_end, days)]
+        while windows:
+            pending = [window for window in windows if window[2] is None]
+            batch = [self.get_adreport_stats2(
+                account_id, data_columns, date_start=start, date_end=end,
+                time_increment=time_increment,
+                actions_group_by=actions_group_by, filters=filters,
+                batch=True) for start, end, _ in pending]
+            responses = self.make_batch_request(batch)
+            if not isinstance(responses, list):
+                responses = [responses] * len(batch)
+            for window, request, response in zip(pending, batch, responses):
+                if isinstance(response, dict) and 'data' in response:
+                    window[2] = list(response['data'])
+                    path, args = parse_relative_url(request['relative_url'])
+                    following = self.next_page_request(path, args, response)
+                    if following:
+                        window[2].extend(
+                            self.iter_rows(following[0], following[2]))
+                    continue
+                start, end = window[:2]
+                code = None
+                if isinstance(response, dict) and 'error' in response:
+                    code = response['error'].get('code')
+                # Only a window that may succeed when smaller is split again
+                retryable = response is None or \
+                    self.retry_policy.retryable('GET', code=code)
+                if start == end or not retryable:
+                    if response is None:
+                        raise urllib2.URLError('no response')
+                    raise AdsAPIError(response)
+                middle = start + datetime.timedelta((end - start).days // 2)
+                idx = windows.index(window)
+                windows[idx:idx + 1] = [
+                    [start, middle, None],
+                    [middle + datetime.timedelta(1), end, None]]
+            while windows and windows[0][2] is not None:
+                yield tuple(windows.pop(0))
+
+    # New API
+    def columnar_adreport_stats2(self, account_id, data_columns,
+                                 date_preset=None, date_start=None,
+                                 date_end=None, time_increment=None,
+                                 actions_group_by=None, filters=None):
+        """Returns the ad report stats for the given account as columns."""
+        return ColumnarReport.from_rows(self.iter_adreport_stats2(
+            account_id, data_columns, date_preset, date_start, date_end,
+            time_increment, actions_group_by, filters), data_columns)
+
     # New API
     def get_async_job_status(self, job_id, batch=False):
         """Returns the asynchronously requested job status"""
@@ -557,16 +3318,73 @@ class AdsAPI(object):
         args = {'fields': 'access_token'}
         return self.make_request(path, 'GET', args, batch=batch)
 
+    def page_access_token(self, page_id):
+        """Returns the page access token from the cache, or fetches it."""
+        token = self.page_tokens.get(page_id)
+        if token is None:
+            token, response = self.page_token_batch(page_id)
+        return token
+
+    def page_token_batch(self, page_id, request=None):
+        """
+        Fetches the page access token and its expiry, together with the
+        given batch request using the token, in a single batched request.
+        Returns the token and the response to the request.
+        """
+        token_request = self.get_page_access_token(page_id, batch=True)
+        token_request.update(name='page_token', omit_response_on_success=False)
+        batch = [
+            token_request,
+            self.debug_token(
+                batch_reference('page_token', '$.access_token'), batch=True),
+        ]
+        if request is not None:
+            batch.append(request)
+        responses = self.make_batch_request(batch)
+        if not isinstance(responses, list):
+            responses = [responses] * len(batch)
+        for response in responses[:2]:
+            if response is None:
+                raise urllib2.URLError('no response for %s' % page_id)
+            if 'error' in response:
+                raise AdsAPIError(response)
+        token = responses[0]['access_token']
+        expires_at = responses[1].get('data', {}).get('expires_at', 0)
+        self.page_tokens.set(page_id, token, expires_at)
+        if request is not None:
+            return token, responses[2]
+        return token, None
+
+    def make_page_request(self, page_id, path, args, files=None, batch=False):
+        """
+        Makes a POST request as the given page. If the page token is not
+        cached yet, it is fetched in the same batch as the request itself.
+        """
+        args = dict(args)
+        token = self.page_tokens.get(page_id)
+        try:
+            if token is not None or files or batch:
+                args['access_token'] = token or self.page_access_token(page_id)
+                return self.make_request(path, 'POST', args, files, batch)
+            args['access_token'] = batch_reference(
+                'page_token', '$.access_token')
+            request = self.make_request(path, 'POST', args, batch=True)
+            token, response = self.page_token_batch(page_id, request)
+            if isinstance(response, dict) and 'error' in response:
+                raise AdsAPIError(response)
+            return response
+        except AdsAPIError as e:
+            if e.code in AUTH_ERROR_CODES:
+                self.page_tokens.evict(page_id)
+            raise
+
     def create_link_page_post(self, page_id, link, message=None, picture=None,
                               thumbnail=None, name=None, caption=None,
                               description=None, published=None, batch=False):
         """Creates a link page post on the given page."""
-        # TODO: this method is calling the API twice; combine them into batch
-        page_access_token = self.get_page_access_token(page_id)
         path = '%s/feed' % page_id
         args = {
             'link': link,
-            'access_token': page_access_token['access_token'],
         }
         files = {}
         if message is not None:
@@ -583,17 +3401,24 @@ class AdsAPI(object):
             args['caption'] = caption
         if description is not None:
             args['description'] = description
-        return self.make_request(path, 'POST', args, files, batch=batch)
+        return self.make_page_request(page_id, path, args, files, batch)
 
     def create_video_page_post(self, page_id, source, title=None,
                                description=None, thumb=None, published=True,
-                               scheduled_publish_time=None, batch=False):
-        # TODO: this method is calling the API twice; combine them into batch
-        page_access_token = self.get_page_access_token(page_id)
+                               scheduled_publish_time=None, chunked=False,
+                               batch=False):
+        """
+        Creates a video page post on the given page. With chunked, the video
+        is sent in a resumable upload session instead of a single request.
+        """
+        if chunked:
+            session = self.create_video_upload_session(
+                page_id, source, title, description, thumb, published,
+                scheduled_publish_time)
+            return session.upload()
         path = '%s/videos' % page_id
         args = {
             'published': published,
-            'access_token': page_access_token['access_token'],
         }
         files = {'source': source}
         if title is not None:
@@ -604,7 +3429,26 @@ class AdsAPI(object):
             files['thumb'] = thumb
         if scheduled_publish_time is not None:
             args['scheduled_publish_time'] = scheduled_publish_time
-        return self.make_request(path, 'POST', args, files, batch=batch)
+        return self.make_page_request(page_id, path, args, files, batch)
+
+    def create_video_upload_session(self, page_id, source, title=None,
+                                    description=None, thumb=None,
+                                    published=True,
+                                    scheduled_publish_time=None, workers=4):
+        """Returns a resumable upload session for a video page post."""
+        args = {'published': published}
+        files = {}
+        if title is not None:
+            args['title'] = title
+        if description is not None:
+            args['description'] = description
+        if thumb is not None:
+            files['thumb'] = thumb
+        if scheduled_publish_time is not None:
+            args['scheduled_publish_time'] = scheduled_publish_time
+        return VideoUploadSession(
+            self, page_id, source, self.page_access_token(page_id), args,
+            files, workers)
 
     # New API
     def create_adcampaign_group(self, account_id, name, campaign_group_status,
@@ -823,6 +3667,30 @@ class AdsAPI(object):
             args['retention_days'] = retention_days
         return self.make_request(path, 'POST', args, batch=batch)
 
+    def add_custom_audience_members(self, audience_id, schema, hashes,
+                                    batch=False):
+        """
+        Adds members, given as hashes of the schema, such as EMAIL_SHA256,
+        to the given custom audience.
+        """
+        path = '%s/users' % audience_id
+        args = {
+            'payload': json.dumps({'schema': schema, 'data': hashes}),
+        }
+        return self.make_request(path, 'POST', args, batch=batch)
+
+    def upload_custom_audience_members(self, audience_id, source,
+                                       schema='EMAIL_SHA256', resume_from=0,
+                                       progress=None, **kwargs):
+        """
+        Normalizes, hashes and uploads the identifiers in source, a file
+        name or an iterable, to the given custom audience in chunks, and
+        returns the number of chunks acknowledged. See AudienceUploader.
+        """
+        uploader = AudienceUploader(self, audience_id, schema,
+                                    progress=progress, **kwargs)
+        return uploader.upload(source, resume_from)
+
     def create_custom_audience_from_website(
             self, account_id, name, domain, description=None,
             retention_days=30, batch=False):
@@ -853,3 +3721,58 @@ class AdsAPI(object):
             'tag': tag,
         }
         return self.make_request(path, 'POST', args, batch=batch)
+
+
+class ThreadedAdsAPI(object):
+    """
+    Runs the request methods of a blocking AdsAPI on a pool of
+    max_concurrency threads, sharing its keep-alive connection pool. Each
+    call returns an AsyncResult right away; its get() returns the response
+    or raises the error of the call. Requests built with batch=True, the
+    iter_ generators and the helpers that send no request, such as batch()
+    and map(), are returned directly.
+
+    Every pending call holds a thread for as long as its request takes, so
+    at most max_concurrency requests are in flight; this is no non-blocking
+    client. To call one method for many items, map() does the same with
+    fewer requests.
+    """
+    # The AdsAPI methods without a batch argument that send requests
+    REQUESTS = frozenset([
+        'columnar_adreport_stats', 'columnar_adreport_stats2',
+        'create_video_upload_session', 'get_adcampaign_detail',
+        'get_adcampaign_list', 'page_access_token',
+        'upload_custom_audience_members'])
+
+    def __init__(self, access_token, app_id, app_secret, max_concurrency=10,
+                 **kwargs):
+        kwargs.setdefault('pool_size', max_concurrency)
+        self.api = AdsAPI(access_token, app_id, app_secret, **kwargs)
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPool(max_concurrency)
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if not inspect.ismethod(attr) or name.startswith('_'):
+            return attr
+        # The batch argument of make_batch_request and the like is the
+        # batch itself, not the flag for building a request
+        spec_args = inspect.getargspec(attr).args
+        if name not in self.REQUESTS and 'batch' not in spec_args:
+            return attr
+        flag = 'batch' in spec_args[2:]
+
+        def method(*args, **kwargs):
+            if flag and inspect.getcallargs(attr, *args, **kwargs)['batch']:
+                return attr(*args, **kwargs)
+            return self.executor.apply_async(attr, args, kwargs)
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        setattr(self, name, method)
+        return method
+
+    def close(self):
+        """Waits for pending calls and closes the pooled connections."""
+        self.executor.close()
+        self.executor.join()
+        self.api.close()
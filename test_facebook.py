@@ -1,16 +1,32 @@
+import BaseHTTPServer
+import collections
+import datetime
+import io
+import json
+import logging
 import os
+import re
+import socket
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
+import urlparse
+import zlib
 
 import facebook
 
-USER_ID = os.environ['USER_ID']
-ACCOUNT_ID = os.environ['ACCOUNT_ID']
-CAMPAIGN_ID = os.environ['CAMPAIGN_ID']
-GROUP_ID = os.environ['GROUP_ID']
-CREATIVE_ID = os.environ['CREATIVE_ID']
-OFFSITE_PIXEL_ID = os.environ['OFFSITE_PIXEL_ID']
-PAGE_ID = os.environ['PAGE_ID']
-STORY_ID = os.environ['STORY_ID']
+ENV_USER_ID = os.environ.get('USER_ID')
+ENV_ACCOUNT_ID = os.environ.get('ACCOUNT_ID')
+ENV_CAMPAIGN_ID = os.environ.get('CAMPAIGN_ID')
+ENV_GROUP_ID = os.environ.get('GROUP_ID')
+ENV_CREATIVE_ID = os.environ.get('CREATIVE_ID')
+ENV_OFFSITE_PIXEL_ID = os.environ.get('OFFSITE_PIXEL_ID')
+ENV_PAGE_ID = os.environ.get('PAGE_ID')
+ENV_STORY_ID = os.environ.get('STORY_ID')
 
 
 class FacebookAdsAPITest(unittest.TestCase):
@@ -43,131 +59,132 @@ class FacebookAdsAPITest(unittest.TestCase):
             pass
 
     def test_get_adusers(self):
-        response = self.api.get_adusers(ACCOUNT_ID)
+        response = self.api.get_adusers(ENV_ACCOUNT_ID)
         self.assertNotIn('error', response)
 
     def test_get_adaccount(self):
-        response = self.api.get_adaccount(ACCOUNT_ID, ['id'])
+        response = self.api.get_adaccount(ENV_ACCOUNT_ID, ['id'])
         self.assertNotIn('error', response)
 
     def test_get_adaccounts(self):
-        response = self.api.get_adaccounts(USER_ID, ['id'])
+        response = self.api.get_adaccounts(ENV_USER_ID, ['id'])
         self.assertNotIn('error', response)
 
     def test_get_adcampaign(self):
-        response = self.api.get_adcampaign(CAMPAIGN_ID, ['id'])
+        response = self.api.get_adcampaign(ENV_CAMPAIGN_ID, ['id'])
         self.assertNotIn('error', response)
 
     def test_get_adcampaigns(self):
-        response = self.api.get_adcampaigns(ACCOUNT_ID, ['id'])
+        response = self.api.get_adcampaigns(ENV_ACCOUNT_ID, ['id'])
         self.assertNotIn('error', response)
 
     def test_get_adgroup(self):
-        response = self.api.get_adgroup(GROUP_ID, ['id'])
+        response = self.api.get_adgroup(ENV_GROUP_ID, ['id'])
         self.assertNotIn('error', response)
 
     def test_get_adgroups_by_adaccount(self):
-        response = self.api.get_adgroups_by_adaccount(ACCOUNT_ID, ['id'])
+        response = self.api.get_adgroups_by_adaccount(ENV_ACCOUNT_ID, ['id'])
         self.assertNotIn('error', response)
 
     def test_get_adgroups_by_adcampaign(self):
-        response = self.api.get_adgroups_by_adcampaign(CAMPAIGN_ID, ['id'])
+        response = self.api.get_adgroups_by_adcampaign(ENV_CAMPAIGN_ID, ['id'])
         self.assertNotIn('error', response)
 
     def test_get_adcreative(self):
-        response = self.api.get_adcreative(CREATIVE_ID, ['id'])
+        response = self.api.get_adcreative(ENV_CREATIVE_ID, ['id'])
         self.assertNotIn('error', response)
 
     def test_get_adcreatives(self):
-        response = self.api.get_adcreatives(ACCOUNT_ID, ['id'])
+        response = self.api.get_adcreatives(ENV_ACCOUNT_ID, ['id'])
         self.assertNotIn('error', response)
 
     def test_get_adimages(self):
-        response = self.api.get_adimages(ACCOUNT_ID)
+        response = self.api.get_adimages(ENV_ACCOUNT_ID)
         self.assertNotIn('error', response)
 
     def test_get_adimages_by_hashes(self):
-        response = self.api.get_adimages(ACCOUNT_ID, [
+        response = self.api.get_adimages(ENV_ACCOUNT_ID, [
             '1026f5ca40f31a8808732e2c59817c3d',
             '0d65031128a5126fba23f4085f9b5256'])
         self.assertNotIn('error', response)
 
     def test_get_stats_by_adaccount(self):
-        response = self.api.get_stats_by_adaccount(ACCOUNT_ID)
+        response = self.api.get_stats_by_adaccount(ENV_ACCOUNT_ID)
         self.assertNotIn('error', response)
 
     def test_get_stats_by_adcampaign(self):
-        response = self.api.get_stats_by_adcampaign(ACCOUNT_ID)
+        response = self.api.get_stats_by_adcampaign(ENV_ACCOUNT_ID)
         self.assertNotIn('error', response)
 
     def test_get_stats_by_adgroup(self):
-        response = self.api.get_stats_by_adgroup(ACCOUNT_ID)
+        response = self.api.get_stats_by_adgroup(ENV_ACCOUNT_ID)
         self.assertNotIn('error', response)
 
     def test_get_stats_by_adgroup_with_ids(self):
-        response = self.api.get_stats_by_adgroup(ACCOUNT_ID, [GROUP_ID])
+        response = self.api.get_stats_by_adgroup(ENV_ACCOUNT_ID,
+                                                 [ENV_GROUP_ID])
         self.assertNotIn('error', response)
 
     def test_get_adreport_stats(self):
         response = self.api.get_adreport_stats(
-            ACCOUNT_ID, 'last_28_days', 'all_days', ['account_id'])
+            ENV_ACCOUNT_ID, 'last_28_days', 'all_days', ['account_id'])
         self.assertNotIn('error', response)
 
     def test_get_conversion_stats_by_adaccount(self):
-        response = self.api.get_conversion_stats_by_adaccount(ACCOUNT_ID)
+        response = self.api.get_conversion_stats_by_adaccount(ENV_ACCOUNT_ID)
         self.assertNotIn('error', response)
 
     def test_get_conversion_stats_by_adcampaign(self):
-        response = self.api.get_conversion_stats_by_adcampaign(ACCOUNT_ID)
+        response = self.api.get_conversion_stats_by_adcampaign(ENV_ACCOUNT_ID)
         self.assertNotIn('error', response)
 
     def test_get_conversion_stats_by_adgroup(self):
-        response = self.api.get_conversion_stats_by_adgroup(ACCOUNT_ID)
+        response = self.api.get_conversion_stats_by_adgroup(ENV_ACCOUNT_ID)
         self.assertNotIn('error', response)
 
     def test_get_conversion_stats(self):
-        response = self.api.get_conversion_stats(GROUP_ID)
+        response = self.api.get_conversion_stats(ENV_GROUP_ID)
         self.assertNotIn('error', response)
 
     def test_get_offsite_pixel(self):
-        response = self.api.get_offsite_pixel(OFFSITE_PIXEL_ID)
+        response = self.api.get_offsite_pixel(ENV_OFFSITE_PIXEL_ID)
         self.assertNotIn('error', response)
 
     def test_get_offsite_pixels(self):
-        response = self.api.get_offsite_pixels(ACCOUNT_ID)
+        response = self.api.get_offsite_pixels(ENV_ACCOUNT_ID)
         self.assertNotIn('error', response)
 
     def test_get_keyword_stats(self):
-        response = self.api.get_keyword_stats(GROUP_ID)
+        response = self.api.get_keyword_stats(ENV_GROUP_ID)
         self.assertNotIn('error', response)
 
     def test_get_ratecard(self):
-        response = self.api.get_ratecard(ACCOUNT_ID)
+        response = self.api.get_ratecard(ENV_ACCOUNT_ID)
         self.assertNotIn('error', response)
 
     def test_get_reach_estimate(self):
         targeting_spec = {'countries': ['KR']}
         response = self.api.get_reach_estimate(
-            ACCOUNT_ID, 'KRW', targeting_spec)
+            ENV_ACCOUNT_ID, 'KRW', targeting_spec)
         self.assertNotIn('error', response)
 
     def test_get_adcampaign_list(self):
-        responses = self.api.get_adcampaign_list(ACCOUNT_ID)
+        responses = self.api.get_adcampaign_list(ENV_ACCOUNT_ID)
         for response in responses:
             self.assertNotIn('error', response)
 
     def test_get_adcampaign_detail(self):
         responses = self.api.get_adcampaign_detail(
-            ACCOUNT_ID, CAMPAIGN_ID, 'last_28_days')
+            ENV_ACCOUNT_ID, ENV_CAMPAIGN_ID, 'last_28_days')
         for response in responses:
             self.assertNotIn('error', response)
 
     def test_get_user_pages(self):
-        response = self.api.get_user_pages(USER_ID)
+        response = self.api.get_user_pages(ENV_USER_ID)
         self.assertNotIn('error', response)
 
     def test_get_page_access_token(self):
-        response = self.api.get_page_access_token(PAGE_ID)
+        response = self.api.get_page_access_token(ENV_PAGE_ID)
         self.assertNotIn('error', response)
 
     def test_get_autocomplete_data(self):
@@ -176,7 +193,7 @@ class FacebookAdsAPITest(unittest.TestCase):
 
     def test_create_link_page_post(self):
         response = self.api.create_link_page_post(
-            PAGE_ID, 'http://www.youtube.com/watch?v=JJXuBSx_1yE',
+            ENV_PAGE_ID, 'http://www.youtube.com/watch?v=JJXuBSx_1yE',
             'Link page post creation test',
         )
         self.assertNotIn('error', response)
@@ -185,7 +202,7 @@ class FacebookAdsAPITest(unittest.TestCase):
         try:
             thumbnail = open('kodim23.png', 'rb')
             response = self.api.create_link_page_post(
-                PAGE_ID, 'http://www.virect.com/', thumbnail=thumbnail
+                ENV_PAGE_ID, 'http://www.virect.com/', thumbnail=thumbnail
             )
             self.assertNotIn('error', response)
         except facebook.AdsAPIError as e:
@@ -194,7 +211,8 @@ class FacebookAdsAPITest(unittest.TestCase):
     def test_create_video_page_post(self):
         try:
             source = open('afm.mp4', 'rb')
-            response = self.api.create_video_page_post(PAGE_ID, source=source)
+            response = self.api.create_video_page_post(ENV_PAGE_ID,
+                                                       source=source)
             self.assertNotIn('error', response)
         except facebook.AdsAPIError as e:
             print e.message
@@ -204,36 +222,1354 @@ class FacebookAdsAPITest(unittest.TestCase):
             source = open('afm.mp4', 'rb')
             thumbnail = open('kodim23.png', 'rb')
             response = self.api.create_video_page_post(
-                PAGE_ID, source=source, thumb=thumbnail)
+                ENV_PAGE_ID, source=source, thumb=thumbnail)
             self.assertNotIn('error', response)
         except facebook.AdsAPIError as e:
             print e.message
 
     def test_create_adcampaign(self):
         response = self.api.create_adcampaign(
-            ACCOUNT_ID, 'Test Campaign', 1, 100)
+            ENV_ACCOUNT_ID, 'Test Campaign', 1, 100)
         self.assertNotIn('error', response)
 
     def test_create_adcreative_type_27(self):
         response = self.api.create_adcreative_type_27(
-            ACCOUNT_ID, PAGE_ID, story_id=STORY_ID,
+            ENV_ACCOUNT_ID, ENV_PAGE_ID, story_id=ENV_STORY_ID,
             name='Test Type 27 Ad Creative')
         self.assertNotIn('error', response)
 
     def test_create_adgroup(self):
         targeting = {'geo_locations': {'countries': ['KR']}}
         conversion_specs = [{"action.type": ["offsite_conversion"],
-                             "offsite_pixel": [OFFSITE_PIXEL_ID]}]
+                             "offsite_pixel": [ENV_OFFSITE_PIXEL_ID]}]
         response = self.api.create_adgroup(
-            ACCOUNT_ID, 'Test Ad Group', 'ABSOLUTE_OCPM', {'ACTIONS': 1000},
-            CAMPAIGN_ID, CREATIVE_ID, targeting, conversion_specs
+            ENV_ACCOUNT_ID, 'Test Ad Group', 'ABSOLUTE_OCPM',
+            {'ACTIONS': 1000}, ENV_CAMPAIGN_ID, ENV_CREATIVE_ID, targeting,
+            conversion_specs
         )
         self.assertNotIn('error', response)
 
     def test_create_offsite_pixel(self):
         response = self.api.create_offsite_pixel(
-            ACCOUNT_ID, 'Test Pixel', 'CHECKOUT')
+            ENV_ACCOUNT_ID, 'Test Pixel', 'CHECKOUT')
         self.assertNotIn('error', response)
 
+
+
+# Objects of the stand-in Graph API, which the offline tests below use
+# instead of the ENV_ objects of a live account
+ACCOUNT_ID = '2'
+CAMPAIGN_ID = '3'
+GROUP_ID = '4'
+PAGE_ID = '7'
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """A keep-alive stand-in for graph.facebook.com."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            server.compressed += 1
+        url = urlparse.urlsplit(self.path)
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.requests.append((self.command, url.path, body))
+            server.headers.append(self.headers)
+        response = server.route(self.command, url.path,
+                                urlparse.parse_qs(url.query), body)
+        status, data, headers = (response + ({},))[:3]
+        payload = json.dumps(data)
+        if server.compress and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            headers = dict(headers, **{'Content-Encoding': 'gzip'})
+            payload = facebook.gzip_compress(payload)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_DELETE = respond
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), StandInHandler)
+        self.lock = threading.Lock()
+        self.connections = set()
+        self.requests = []
+        self.routes = {}
+        self.compress = False
+        self.compressed = 0
+        self.headers = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def route(self, method, path, query, body):
+        handler = self.routes.get((method, path))
+        if handler is None:
+            return 200, {'id': path.strip('/'), 'method': method}
+        return handler(query, body)
+
+    def batch(self, query, body):
+        """Answers each operation of a batch through its own route."""
+        batch = json.loads(urlparse.parse_qs(body)['batch'][0])
+        results = {}
+        responses = []
+
+        def resolve(match):
+            value = results[match.group(1)]
+            for key in match.group(2).split('.')[1:]:
+                value = value[key]
+            return str(value)
+        for op in batch:
+            relative_url = re.sub(r'{result=(\w+):([$.\w]+)}', resolve,
+                                  op['relative_url'])
+            url = urlparse.urlsplit('/' + relative_url)
+            status, data = self.route(op['method'], url.path,
+                                      urlparse.parse_qs(url.query), '')[:2]
+            if 'name' in op:
+                results[op['name']] = data
+            responses.append({'code': status, 'body': json.dumps(data)})
+        return 200, responses
+
+    def start(self):
+        self.routes.setdefault(('POST', '/'), self.batch)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class StandInTestCase(unittest.TestCase):
+    """Runs the client against a local stand-in Graph API server."""
+
+    def setUp(self):
+        self.server = StandInServer().start()
+        self.facebook_api = facebook.FACEBOOK_API
+        facebook.FACEBOOK_API = self.server.url
+        self.api = facebook.AdsAPI('token', 'app_id', 'app_secret')
+
+    def tearDown(self):
+        facebook.FACEBOOK_API = self.facebook_api
+        self.api.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ConnectionPoolTest(StandInTestCase):
+    """Tests for the keep-alive connection pool."""
+
+    def test_keep_alive(self):
+        self.api.get_adaccount(ACCOUNT_ID)
+        self.api.delete_adcampaign(CAMPAIGN_ID)
+        self.api.create_offsite_pixel(ACCOUNT_ID, 'Test Pixel', 'CHECKOUT')
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_multipart(self):
+        with open('kodim23.png', 'rb') as thumbnail:
+            response = self.api.make_request(
+                '%s/feed' % PAGE_ID, 'POST', {'link': 'http://a.b/'},
+                {'thumbnail': thumbnail})
+        self.assertEqual(response['method'], 'POST')
+
+    def test_pool_size(self):
+        self.api = facebook.AdsAPI('token', 'app_id', 'app_secret',
+                                   pool_size=2)
+        threads = [threading.Thread(target=self.api.get_adgroup,
+                                    args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.requests), 10)
+        self.assertTrue(len(self.server.connections) <= 2)
+
+    def test_idle_reaping(self):
+        self.api = facebook.AdsAPI('token', 'app_id', 'app_secret',
+                                   idle_timeout=-1)
+        self.api.get_adgroup(GROUP_ID)
+        self.api.get_adgroup(GROUP_ID)
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_error_handling(self):
+        self.server.routes[('GET', '/debug_token')] = lambda query, body: (
+            400, {'error': {'message': 'Invalid token', 'code': 190,
+                            'type': 'OAuthException'}})
+        with self.assertRaises(facebook.AdsAPIError) as cm:
+            self.api.debug_token('')
+        self.assertEqual(cm.exception.code, 190)
+        self.api.get_adgroup(GROUP_ID)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_no_resend_after_timeout(self):
+        self.server.routes[('POST', '/act_%s/adgroups' % ACCOUNT_ID)] = \
+            lambda query, body: time.sleep(1) or (200, {'id': '1'})
+        self.api = facebook.AdsAPI('token', 'app_id', 'app_secret',
+                                   timeout=0.3)
+        self.api.get_adgroup(GROUP_ID)
+        self.assertIsNone(self.api.make_request(
+            'act_%s/adgroups' % ACCOUNT_ID, 'POST', {'name': 'group'}))
+        posts = [request for request in self.server.requests
+                 if request[0] == 'POST']
+        self.assertEqual(len(posts), 1)
+
+    def test_resend_on_dropped_connection(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        accepted = []
+
+        def serve():
+            # Answers a single request on each connection, then drops it
+            while True:
+                conn = listener.accept()[0]
+                accepted.append(conn)
+                data = ''
+                while '\r\n\r\n' not in data:
+                    data += conn.recv(4096)
+                conn.sendall('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n'
+                             'Content-Type: application/json\r\n\r\n{}')
+                conn.close()
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        pool = facebook.ConnectionPool()
+        url = 'http://127.0.0.1:%d/1' % listener.getsockname()[1]
+        try:
+            for i in range(2):
+                self.assertEqual(pool.urlopen('GET', url).read(), '{}')
+        finally:
+            pool.close()
+            listener.close()
+        self.assertEqual(len(accepted), 2)
+
+
+class TransportTest(StandInTestCase):
+    """Tests for interchangeable transports."""
+
+    def test_urllib_transport(self):
+        self.api = facebook.AdsAPI('token', 'app_id', 'app_secret',
+                                   transport=facebook.UrllibTransport())
+        self.assertIsNone(self.api.pool)
+        self.assertEqual(self.api.get_adgroup(GROUP_ID)['id'], str(GROUP_ID))
+        self.assertEqual(self.api.delete_adcampaign(CAMPAIGN_ID)['method'],
+                         'DELETE')
+        with open('kodim23.png', 'rb') as thumbnail:
+            response = self.api.make_request(
+                '%s/feed' % PAGE_ID, 'POST', {'link': 'http://a.b/'},
+                {'thumbnail': thumbnail})
+        self.assertEqual(response['method'], 'POST')
+        self.server.routes[('GET', '/5')] = lambda query, body: (400, {
+            'error': {'message': 'Invalid', 'code': 100, 'type': 'Error'}})
+        with self.assertRaises(facebook.AdsAPIError) as cm:
+            self.api.get_adgroup(5)
+        self.assertEqual(cm.exception.status, 400)
+
+    def test_custom_transport(self):
+        class RecordingTransport(facebook.PooledTransport):
+            def send(self, method, url, headers, body=None):
+                sent.append((method, url.split('?')[0]))
+                return super(RecordingTransport, self).send(
+                    method, url, headers, body)
+        sent = []
+        self.api = facebook.AdsAPI('token', 'app_id', 'app_secret',
+                                   transport=RecordingTransport())
+        self.api.get_adgroup(GROUP_ID)
+        self.assertEqual(sent, [('GET', '%s/%s' % (self.server.url,
+                                                   GROUP_ID))])
+
+
+class MultipartFormdataEncoderTest(StandInTestCase):
+    """Tests for the streaming multipart encoder."""
+
+    def test_stream(self):
+        encoder = facebook.MultipartFormdataEncoder()
+        with open('afm.mp4', 'rb') as source:
+            content_type, body = encoder.encode({'title': 'AFM'},
+                                                {'source': source})
+            source.seek(0)
+            content_type, stream = encoder.stream(
+                {'title': 'AFM'}, {'source': source}, chunk_size=4096)
+            chunks = list(stream)
+        self.assertEqual(len(stream), len(body))
+        self.assertEqual(''.join(chunks), body)
+        self.assertTrue(all(len(chunk) == 4096 for chunk in chunks[:-1]))
+        self.assertTrue(body.endswith('--%s--\r\n' % encoder.boundary))
+
+    def test_stream_upload(self):
+        with open('afm.mp4', 'rb') as source:
+            self.api.make_request('%s/videos' % PAGE_ID, 'POST',
+                                  {'title': 'AFM'}, {'source': source})
+            size = os.fstat(source.fileno()).st_size
+        method, path, body = self.server.requests[0]
+        self.assertIn('filename="afm.mp4"', body)
+        self.assertTrue(len(body) > size)
+
+
+class VideoUploadSessionTest(StandInTestCase):
+    """Tests for resumable chunked video uploads."""
+
+    def setUp(self):
+        super(VideoUploadSessionTest, self).setUp()
+        self.failures = {}
+        self.server.routes[('GET', '/%s' % PAGE_ID)] = lambda query, body: (
+            200, {'access_token': 'page_token', 'id': PAGE_ID})
+        self.server.routes[('POST', '/%s/videos' % PAGE_ID)] = self.videos
+
+    def field(self, body, name):
+        match = re.search(r'name="%s"\r\n\r\n([^\r]*)' % name, body)
+        if match:
+            return match.group(1)
+        return urlparse.parse_qs(body).get(name, [None])[0]
+
+    def videos(self, query, body):
+        phase = self.field(body, 'upload_phase')
+        if phase == 'start':
+            return 200, {'upload_session_id': '1', 'video_id': '2',
+                         'start_offset': '0', 'end_offset': '300000'}
+        if phase == 'transfer':
+            offset = int(self.field(body, 'start_offset'))
+            if self.failures.get(offset):
+                self.failures[offset] -= 1
+                return 500, {'error': {'message': 'Try again', 'code': 2,
+                                       'type': 'FacebookApiException'}}
+            return 200, {'start_offset': str(offset + 300000),
+                         'end_offset': str(offset + 600000)}
+        return 200, {'success': True}
+
+    def transfers(self):
+        return [self.field(body, 'start_offset')
+                for method, path, body in self.server.requests
+                if self.field(body, 'upload_phase') == 'transfer']
+
+    def test_chunked_upload(self):
+        with open('afm.mp4', 'rb') as source:
+            response = self.api.create_video_page_post(
+                PAGE_ID, source, title='AFM', chunked=True)
+        self.assertEqual(response, {'success': True})
+        self.assertEqual(sorted(self.transfers(), key=int),
+                         ['0', '300000', '600000', '900000', '1200000'])
+
+    def test_resume(self):
+        self.failures[600000] = 4
+        with open('afm.mp4', 'rb') as source:
+            session = self.api.create_video_upload_session(PAGE_ID, source)
+            self.assertRaises(facebook.AdsAPIError, session.upload)
+            self.assertEqual(session.pending, [600000])
+            self.assertEqual(session.upload(), {'success': True})
+        self.assertEqual(self.transfers().count('0'), 1)
+        self.assertEqual(self.transfers().count('600000'), 5)
+
+
+class BatchRequestTest(StandInTestCase):
+    """Tests for splitting and dispatching large batches."""
+
+    def test_split(self):
+        batch = [self.api.get_adgroup(i, batch=True) for i in range(120)]
+        response = self.api.make_batch_request(batch)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual([data['id'] for data in response],
+                         [str(i) for i in range(120)])
+
+    def test_labeled_split(self):
+        batch = dict((i, self.api.get_adgroup(i, batch=True))
+                     for i in range(60))
+        response = self.api.make_labeled_batch_request(batch)
+        self.assertEqual(len(self.server.requests), 2)
+        for label, data in response.items():
+            self.assertEqual(data['id'], str(label))
+
+    def test_failed_sub_batch(self):
+        error = {'error': {'message': 'Too many calls', 'code': 4,
+                           'type': 'OAuthException'}}
+
+        def batch(query, body):
+            urls = [op['relative_url'] for op in
+                    json.loads(urlparse.parse_qs(body)['batch'][0])]
+            if '0?' in urls or '100?' in urls:
+                return 400, error
+            return self.server.batch(query, body)
+        self.server.routes[('POST', '/')] = batch
+        batch = [self.api.get_adgroup(i, batch=True) for i in range(120)]
+        response = self.api.make_batch_request(batch)
+        self.assertEqual(response[:50], [error] * 50)
+        self.assertEqual(response[50]['id'], '50')
+        self.assertEqual(response[100:], [error] * 20)
+
+
+class BatchBuilderTest(StandInTestCase):
+    """Tests for batches of operations referring to each other."""
+
+    def setUp(self):
+        super(BatchBuilderTest, self).setUp()
+        self.server.routes[
+            ('POST', '/act_%s/adcampaign_groups' % ACCOUNT_ID)] = \
+            lambda query, body: (200, {'id': '11'})
+        self.server.routes[('POST', '/act_%s/adcampaigns' % ACCOUNT_ID)] = \
+            lambda query, body: (200, {
+                'id': '12',
+                'campaign_group_id': query['campaign_group_id'][0]})
+
+    def test_campaign_tree(self):
+        builder = self.api.batch_builder()
+        group = builder.add(self.api.create_adcampaign_group(
+            ACCOUNT_ID, 'group', 'PAUSED', batch=True), 'group')
+        builder.add(self.api.create_adset(
+            ACCOUNT_ID, group, 'set', 'PAUSED', daily_budget=100,
+            batch=True), 'set',
+            depends_on='group')
+        responses = builder.execute()
+        self.assertEqual(responses[1], {'id': '12', 'campaign_group_id': '11'})
+        self.assertEqual(builder.results['group'], {'id': '11'})
+        self.assertEqual(len(self.server.requests), 1)
+        batch = json.loads(urlparse.parse_qs(
+            self.server.requests[0][2])['batch'][0])
+        self.assertFalse(batch[0]['omit_response_on_success'])
+        self.assertEqual(batch[1]['depends_on'], 'group')
+
+    def test_limits(self):
+        builder = self.api.batch_builder()
+        with self.assertRaises(ValueError):
+            builder.ref('group')
+        for i in range(self.api.BATCH_LIMIT):
+            builder.add(self.api.get_adgroup(i, batch=True))
+        with self.assertRaises(ValueError):
+            builder.add(self.api.get_adgroup(0, batch=True))
+
+    def test_named_labels(self):
+        batch = collections.OrderedDict()
+        batch['group'] = self.api.create_adcampaign_group(
+            ACCOUNT_ID, 'group', 'PAUSED', batch=True)
+        batch['set'] = self.api.create_adset(
+            ACCOUNT_ID, facebook.batch_reference('group'), 'set', 'PAUSED',
+            daily_budget=100, batch=True)
+        data = self.api.make_labeled_batch_request(batch, named=True)
+        self.assertEqual(data['set']['campaign_group_id'], '11')
+
+
+class DeferredBatchTest(StandInTestCase):
+    """Tests for deferred batches of method calls."""
+
+    def test_flush_on_exit_and_size(self):
+        self.server.routes[('GET', '/5')] = lambda query, body: (400, {
+            'error': {'message': 'Invalid', 'code': 100, 'type': 'Error'}})
+        with self.api.batch(size=3) as batch:
+            futures = [batch.get_adgroup(i) for i in range(7)]
+            self.assertTrue(futures[2].done())
+            self.assertFalse(futures[6].done())
+            self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(futures[6].result()['id'], '6')
+        with self.assertRaises(facebook.AdsAPIError):
+            futures[5].result()
+
+    def test_flush_on_result(self):
+        with self.api.batch() as batch:
+            futures = [batch.get_adgroup(i) for i in range(3)]
+            self.assertEqual(futures[1].result()['id'], '1')
+            self.assertTrue(futures[2].done())
+            self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_flush_on_max_wait(self):
+        batch = self.api.batch(max_wait=0.05)
+        future = batch.get_adgroup(1)
+        self.assertEqual(future.result(5)['id'], '1')
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class SingleFlightTest(StandInTestCase):
+    """Tests for coalescing identical requests."""
+
+    def test_concurrent_gets(self):
+        def adgroup(query, body):
+            time.sleep(0.2)
+            return 200, {'id': '1', 'fields': query.get('fields')}
+        self.server.routes[('GET', '/1')] = adgroup
+        results = []
+
+        def get():
+            results.append(self.api.get_adgroup(1))
+        threads = [threading.Thread(target=get) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.api.in_flight.shared, 4)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(set(id(result) for result in results)), 5)
+        self.api.get_adgroup(1)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_batch_duplicates(self):
+        batch = [self.api.get_adgroup(1, batch=True),
+                 self.api.get_adgroup(2, batch=True),
+                 self.api.get_adgroup(1, batch=True)]
+        data = self.api.make_batch_request(batch)
+        self.assertEqual([response['id'] for response in data],
+                         ['1', '2', '1'])
+        self.assertIsNot(data[0], data[2])
+        sent = json.loads(urlparse.parse_qs(
+            self.server.requests[0][2])['batch'][0])
+        self.assertEqual(len(sent), 2)
+
+
+class CompressionTest(StandInTestCase):
+    """Tests for compressed requests and responses."""
+
+    def setUp(self):
+        super(CompressionTest, self).setUp()
+        self.server.compress = True
+
+    def test_responses(self):
+        rows = [{'spend': i, 'age': '18-24'} for i in range(2000)]
+        self.server.routes[('GET', '/act_%s/reportstats' % ACCOUNT_ID)] = \
+            lambda query, body: (200, {'data': rows})
+        self.assertEqual(list(self.api.iter_adreport_stats(
+            ACCOUNT_ID, 'last_28_days', 'all_days', ['spend'])), rows)
+        self.assertEqual(self.api.get_adgroup(GROUP_ID)['id'], str(GROUP_ID))
+        data = self.api.make_batch_request(
+            [self.api.get_adgroup(i, batch=True) for i in range(3)])
+        self.assertEqual([response['id'] for response in data],
+                         ['0', '1', '2'])
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_error_response(self):
+        self.server.routes[('GET', '/%s' % GROUP_ID)] = \
+            lambda query, body: (400, {'error': {
+                'message': 'Invalid', 'code': 100, 'type': 'Error'}})
+        with self.assertRaises(facebook.AdsAPIError) as cm:
+            self.api.get_adgroup(GROUP_ID)
+        self.assertEqual(cm.exception.code, 100)
+
+    def test_request_compression(self):
+        self.api.compress_requests = True
+        batch = [self.api.get_adgroup(i, batch=True) for i in range(40)]
+        data = self.api.make_batch_request(batch)
+        self.assertEqual(data[39]['id'], '39')
+        self.assertIn('batch=', self.server.requests[0][2])
+        self.assertEqual(self.server.compressed, 1)
+        self.api.get_adgroup(GROUP_ID)
+        self.assertEqual(self.server.compressed, 1)
+
+    def test_streamed_upload_headers(self):
+        with open('kodim23.png', 'rb') as thumbnail:
+            self.api.make_request(
+                '%s/feed' % PAGE_ID, 'POST', {'link': 'http://a.b/'},
+                {'thumbnail': thumbnail})
+        headers = self.server.headers[0]
+        self.assertEqual(headers.getheaders('Accept-Encoding'),
+                         ['gzip, deflate'])
+        self.assertEqual(len(headers.getheaders('Host')), 1)
+
+    def test_raw_deflate(self):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compressor.compress('x' * 1000) + compressor.flush()
+        response = facebook.DecodedResponse(io.BytesIO(data), chunk_size=1)
+        self.assertEqual(response.read(), 'x' * 1000)
+        response = facebook.DecodedResponse(io.BytesIO(
+            zlib.compress('y' * 1000)))
+        self.assertEqual(response.read(), 'y' * 1000)
+
+
+class MetricsTest(StandInTestCase):
+    """Tests for per-endpoint request metrics."""
+
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.api = facebook.AdsAPI('token', 'app_id', 'app_secret',
+                                   cache=True, metrics=True)
+
+    def test_metrics(self):
+        self.server.routes[('GET', '/5')] = lambda query, body: (400, {
+            'error': {'message': 'Invalid', 'code': 100, 'type': 'Error'}})
+        self.api.get_adaccount(ACCOUNT_ID)
+        self.api.get_adaccount(ACCOUNT_ID)
+        with self.assertRaises(facebook.AdsAPIError):
+            self.api.get_adgroup(5)
+        self.api.make_batch_request(
+            [self.api.get_adgroup(i, batch=True) for i in range(4, 7)])
+        snapshot = self.api.metrics.snapshot()
+        account = snapshot['endpoints']['act_{id}']
+        self.assertEqual(account['calls'], 1)
+        self.assertEqual(account['cache_hits'], 1)
+        self.assertEqual(account['cache_misses'], 1)
+        self.assertTrue(account['bytes_received'] > 0)
+        self.assertEqual(account['latency']['+Inf'], 1)
+        group = snapshot['endpoints']['{id}']
+        self.assertEqual(group['errors'], {100: 2})
+        self.assertEqual(group['batched'], 3)
+        self.assertEqual(snapshot['endpoints']['batch']['calls'], 1)
+        self.assertEqual(snapshot['batch_sizes']['5'], 1)
+        text = self.api.metrics.prometheus()
+        self.assertIn('facebook_ads_requests_total{endpoint="act_{id}"} 1\n',
+                      text)
+        self.assertIn('facebook_ads_errors_total{endpoint="{id}",code="100"} '
+                      '2\n', text)
+        self.assertIn('facebook_ads_batch_size_count 1\n', text)
+
+    def test_redacted_logging(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = lambda record: records.append(record.getMessage())
+        facebook.logger.addHandler(handler)
+        facebook.logger.setLevel(logging.INFO)
+        try:
+            self.api.debug_token('secret', batch=False)
+            self.api.make_batch_request([self.api.debug_token(
+                'secret2', batch=True), self.api.get_adgroup(1, batch=True)])
+        finally:
+            facebook.logger.removeHandler(handler)
+            facebook.logger.setLevel(logging.NOTSET)
+        self.assertEqual(len(records), 2)
+        for record in records:
+            self.assertNotIn('secret', record)
+            self.assertIn('<redacted>', record)
+
+
+class ImageUploaderTest(StandInTestCase):
+    """Tests for deduplicated ad image uploads."""
+
+    def setUp(self):
+        super(ImageUploaderTest, self).setUp()
+        self.existing = set([facebook.file_md5('afm.mp4')])
+        self.server.routes[('GET', '/act_%s/adimages' % ACCOUNT_ID)] = \
+            lambda query, body: (200, {'data': [
+                {'hash': image_hash}
+                for image_hash in json.loads(query['hashes'][0])
+                if image_hash in self.existing]})
+        self.server.routes[('POST', '/act_%s/adimages' % ACCOUNT_ID)] = \
+            self.adimages
+        self.copy = tempfile.NamedTemporaryFile(suffix='.png')
+        with open('kodim23.png', 'rb') as f:
+            self.copy.write(f.read())
+        self.copy.flush()
+
+    def tearDown(self):
+        self.copy.close()
+        super(ImageUploaderTest, self).tearDown()
+
+    def adimages(self, query, body):
+        names = re.findall(r'name="(\w+)\.\w+"; filename=', body)
+        return 200, {'images': dict(
+            (name, {'hash': name, 'url': 'http://a.b/%s' % name})
+            for name in names)}
+
+    def uploads(self):
+        return [body for method, path, body in self.server.requests
+                if method == 'POST']
+
+    def test_upload(self):
+        uploader = facebook.ImageUploader(self.api)
+        filenames = ['kodim23.png', self.copy.name, 'afm.mp4']
+        hashes = uploader.upload(ACCOUNT_ID, filenames)
+        kodim23 = facebook.file_md5('kodim23.png')
+        self.assertEqual(hashes[self.copy.name], kodim23)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(self.uploads()), 1)
+        self.assertIn('name="%s.png"' % kodim23, self.uploads()[0])
+        self.assertEqual(uploader.known(ACCOUNT_ID, hashes.values()),
+                         set(hashes.values()))
+        uploader.upload(ACCOUNT_ID, filenames)
+        self.assertEqual(len(self.server.requests), 2)
+        uploader.close()
+
+    def test_files_per_request(self):
+        self.existing = set()
+        uploader = facebook.ImageUploader(self.api, files_per_request=1)
+        uploader.upload(ACCOUNT_ID, ['kodim23.png', 'afm.mp4'])
+        self.assertEqual(len(self.uploads()), 2)
+
+
+class AudienceUploaderTest(StandInTestCase):
+    """Tests for chunked custom audience member uploads."""
+    audience_id = 9
+
+    def setUp(self):
+        super(AudienceUploaderTest, self).setUp()
+        self.payloads = []
+        self.fail = None
+        self.server.routes[('POST', '/%s/users' % self.audience_id)] = \
+            self.users
+
+    def users(self, query, body):
+        payload = json.loads(urlparse.parse_qs(body)['payload'][0])
+        if self.fail in payload['data']:
+            return 400, {'error': {'message': 'Invalid', 'code': 100,
+                                   'type': 'OAuthException'}}
+        self.payloads.append(payload)
+        return 200, {'audience_id': self.audience_id,
+                     'num_received': len(payload['data'])}
+
+    def test_upload(self):
+        source = io.BytesIO(''.join(
+            ' User%d@Example.com \n' % i for i in range(25)) + '\n')
+        progress = []
+        chunks = self.api.upload_custom_audience_members(
+            self.audience_id, source, chunk_size=10, processes=2,
+            progress=lambda chunks, rows: progress.append((chunks, rows)))
+        self.assertEqual(chunks, 3)
+        self.assertEqual(progress, [(1, 10), (2, 20), (3, 26)])
+        hashes = sorted(sum([payload['data'] for payload in self.payloads],
+                            []))
+        self.assertEqual(hashes, sorted(facebook.hash_members(
+            'EMAIL_SHA256', ['user%d@example.com' % i for i in range(25)])))
+        self.assertEqual(set(payload['schema'] for payload in self.payloads),
+                         set(['EMAIL_SHA256']))
+        self.assertEqual(
+            facebook.hash_members('PHONE_SHA256', ['+1 (650)', '']),
+            facebook.hash_members('PHONE_SHA256', ['1650']))
+
+    def test_resume(self):
+        phones = ['+1 650 555 %04d' % i for i in range(30)]
+        self.fail = facebook.hash_members('PHONE_SHA256', [phones[15]])[0]
+        uploader = facebook.AudienceUploader(
+            self.api, self.audience_id, 'PHONE_SHA256', chunk_size=10,
+            processes=0, workers=1, in_flight=1)
+        with self.assertRaises(facebook.AdsAPIError):
+            uploader.upload(iter(phones))
+        self.assertEqual(uploader.acknowledged, 1)
+        self.fail = None
+        self.assertEqual(uploader.upload(iter(phones), uploader.acknowledged),
+                         3)
+        self.assertEqual(len(self.payloads), 3)
+
+
+class PagingTest(StandInTestCase):
+    """Tests for the cursor-following list iterators."""
+
+    def adgroups(self, query, body):
+        limit = int(query['limit'][0])
+        start = int(query.get('after', ['0'])[0])
+        end = min(start + limit, 250)
+        page = {'data': [{'id': str(i)} for i in range(start, end)],
+                'paging': {'cursors': {'after': str(end)}}}
+        if end < 250:
+            page['paging']['next'] = '%s/act_%s/adgroups?after=%d' % (
+                self.server.url, ACCOUNT_ID, end)
+        return 200, page
+
+    def test_iter_adgroups_by_adaccount(self):
+        self.server.routes[('GET', '/act_%s/adgroups' % ACCOUNT_ID)] = \
+            self.adgroups
+        adgroups = self.api.iter_adgroups_by_adaccount(
+            ACCOUNT_ID, ['id'], page_size=100)
+        self.assertEqual([adgroup['id'] for adgroup in adgroups],
+                         [str(i) for i in range(250)])
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_iter_without_prefetch(self):
+        self.server.routes[('GET', '/act_%s/adgroups' % ACCOUNT_ID)] = \
+            self.adgroups
+        adgroups = self.api.iter_edge('act_%s/adgroups' % ACCOUNT_ID,
+                                      page_size=200, prefetch=False)
+        self.assertEqual(len(list(adgroups)), 250)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_failed_page(self):
+        class FailingTransport(facebook.PooledTransport):
+            def send(self, method, url, headers, body=None):
+                if 'after=' in url:
+                    raise urllib2.URLError('timed out')
+                return super(FailingTransport, self).send(
+                    method, url, headers, body)
+        self.server.routes[('GET', '/act_%s/adgroups' % ACCOUNT_ID)] = \
+            self.adgroups
+        self.api = facebook.AdsAPI(
+            'token', 'app_id', 'app_secret', transport=FailingTransport(),
+            retry_policy=facebook.RetryPolicy(max_attempts=1))
+        adgroups = []
+        with self.assertRaises(urllib2.URLError):
+            for adgroup in self.api.iter_edge(
+                    'act_%s/adgroups' % ACCOUNT_ID, page_size=100):
+                adgroups.append(adgroup)
+        self.assertEqual(len(adgroups), 100)
+
+
+class ThreadedAdsAPITest(StandInTestCase):
+    """Tests for running AdsAPI methods on a thread pool."""
+
+    def test_concurrent_calls(self):
+        api = facebook.ThreadedAdsAPI('token', 'app_id', 'app_secret',
+                                      max_concurrency=4)
+        results = [api.get_adgroup(i) for i in range(20)]
+        self.assertEqual([result.get()['id'] for result in results],
+                         [str(i) for i in range(20)])
+        self.assertTrue(len(self.server.connections) <= 4)
+        api.close()
+
+    def test_batch(self):
+        api = facebook.ThreadedAdsAPI('token', 'app_id', 'app_secret')
+        request = api.get_adgroup(GROUP_ID, batch=True)
+        self.assertEqual(request, self.api.get_adgroup(GROUP_ID, batch=True))
+        self.assertEqual(api.get_adgroup(GROUP_ID, None, True), request)
+        data = api.make_batch_request([request]).get()
+        self.assertEqual(data[0]['id'], str(GROUP_ID))
+        api.close()
+
+    def test_helpers(self):
+        api = facebook.ThreadedAdsAPI('token', 'app_id', 'app_secret')
+        with api.batch() as batch:
+            future = batch.get_adgroup(1)
+        self.assertEqual(future.result()['id'], '1')
+        results = list(api.map(api.api.get_adgroup, [2, 3]))
+        self.assertEqual(sorted(result.result['id'] for result in results),
+                         ['2', '3'])
+        self.assertTrue(isinstance(api.batch_builder(), facebook.BatchBuilder))
+        api.close()
+
+
+class MapTest(StandInTestCase):
+    """Tests for fanning a method out over many accounts."""
+
+    def setUp(self):
+        super(MapTest, self).setUp()
+        self.server.routes[('GET', '/act_13/adcampaignstats')] = \
+            lambda query, body: (400, {'error': {
+                'message': 'No such account', 'code': 100,
+                'type': 'OAuthException'}})
+
+    def test_batched(self):
+        results = list(self.api.map(self.api.get_stats_by_adaccount,
+                                    range(120)))
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(sorted(result.args[0] for result in results),
+                         range(120))
+        for result in results:
+            if result.args == (13,):
+                self.assertEqual(result.error.code, 100)
+            else:
+                self.assertEqual(result.result['id'],
+                                 'act_%s/adcampaignstats' % result.args)
+                self.assertEqual(result.error, None)
+
+    def test_batch_limit(self):
+        results = list(self.api.map(self.api.get_stats_by_adaccount,
+                                    range(120), batch_size=100))
+        self.assertEqual(len(results), 120)
+        self.assertEqual(len(self.server.requests), 3)
+        for method, path, body in self.server.requests:
+            batch = json.loads(urlparse.parse_qs(body)['batch'][0])
+            self.assertTrue(len(batch) <= facebook.AdsAPI.BATCH_LIMIT)
+
+    def test_unbatched(self):
+        results = list(self.api.map('get_adcampaign_list', [1, 13, 2]))
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(self.server.requests), 3)
+
+
+class ResponseCacheTest(StandInTestCase):
+    """Tests for the GET response cache."""
+
+    def setUp(self):
+        super(ResponseCacheTest, self).setUp()
+        self.api.cache = facebook.ResponseCache(
+            maxsize=2, ttl=60, ttls={'act_{id}/adcampaignstats': 0})
+
+    def test_default_ttls(self):
+        self.api = facebook.AdsAPI('token', 'app_id', 'app_secret',
+                                   cache=True)
+        for i in range(2):
+            self.api.get_adaccount(ACCOUNT_ID, ['currency'])
+            self.api.get_async_job_status(900)
+            self.api.make_batch_request(
+                [self.api.get_async_job_status(900, batch=True)])
+        paths = [path for method, path, body in self.server.requests]
+        self.assertEqual(paths.count('/act_%s' % ACCOUNT_ID), 1)
+        self.assertEqual(paths.count('/900'), 2)
+        self.assertEqual(paths.count('/'), 2)
+
+    def test_hit(self):
+        first = self.api.get_adaccount(ACCOUNT_ID, ['currency'])
+        first['mutated'] = True
+        second = self.api.get_adaccount(ACCOUNT_ID, ['currency'])
+        self.assertNotIn('mutated', second)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.api.cache.stats(),
+                         {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_invalidate(self):
+        self.api.get_adcampaign(CAMPAIGN_ID, ['name'])
+        self.api.update_adcampaign(CAMPAIGN_ID, name='Renamed')
+        self.api.get_adcampaign(CAMPAIGN_ID, ['name'])
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_invalidate_lazy_batch(self):
+        self.api.get_adcampaign(CAMPAIGN_ID, ['name'])
+        self.api.make_batch_request(
+            [self.api.update_adcampaign(CAMPAIGN_ID, name='Renamed',
+                                        batch=True)], lazy=True)
+        self.api.get_adcampaign(CAMPAIGN_ID, ['name'])
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_invalidate_named_write(self):
+        self.api.get_adcampaign(CAMPAIGN_ID, ['name'])
+        builder = self.api.batch_builder()
+        builder.add(self.api.update_adcampaign(
+            CAMPAIGN_ID, name='Renamed', batch=True), name='rename')
+        builder.execute()
+        self.api.get_adcampaign(CAMPAIGN_ID, ['name'])
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_eviction(self):
+        for adgroup_id in (1, 2, 1, 3, 1, 2):
+            self.api.get_adgroup(adgroup_id)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_batch(self):
+        self.api.get_adcampaign_list(ACCOUNT_ID)
+        self.api.get_adcampaign_list(ACCOUNT_ID)
+        method, path, body = self.server.requests[-1]
+        batch = json.loads(urlparse.parse_qs(body)['batch'][0])
+        self.assertEqual([op['relative_url'] for op in batch],
+                         ['act_%s/adcampaignstats?' % ACCOUNT_ID])
+
+
+class PageTokenCacheTest(StandInTestCase):
+    """Tests for caching page access tokens."""
+
+    def setUp(self):
+        super(PageTokenCacheTest, self).setUp()
+        self.token = 'page_token'
+        self.server.routes[('GET', '/%s' % PAGE_ID)] = lambda query, body: (
+            200, {'access_token': self.token, 'id': PAGE_ID})
+        self.server.routes[('GET', '/debug_token')] = lambda query, body: (
+            200, {'data': {'expires_at': 0}})
+        self.server.routes[('POST', '/%s/feed' % PAGE_ID)] = self.feed
+
+    def feed(self, query, body):
+        query = query or urlparse.parse_qs(body)
+        if query['access_token'] != [self.token]:
+            return 400, {'error': {'message': 'Invalid token', 'code': 190,
+                                   'type': 'OAuthException'}}
+        return 200, {'id': '%s_1' % PAGE_ID}
+
+    def test_cold_page(self):
+        response = self.api.create_link_page_post(PAGE_ID, 'http://a.b/')
+        self.assertEqual(response, {'id': '%s_1' % PAGE_ID})
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.api.page_tokens.get(PAGE_ID), 'page_token')
+
+    def test_warm_page(self):
+        self.api.create_link_page_post(PAGE_ID, 'http://a.b/')
+        self.api.create_link_page_post(PAGE_ID, 'http://a.b/')
+        self.assertEqual(len(self.server.requests), 2)
+        method, path, body = self.server.requests[-1]
+        self.assertEqual(path, '/%s/feed' % PAGE_ID)
+
+    def test_expiry(self):
+        self.api.page_tokens.set(PAGE_ID, 'page_token', time.time() + 60)
+        self.assertEqual(self.api.page_tokens.get(PAGE_ID), None)
+
+    def test_auth_error(self):
+        self.api.create_link_page_post(PAGE_ID, 'http://a.b/')
+        self.token = 'new_page_token'
+        self.assertRaises(facebook.AdsAPIError,
+                          self.api.create_link_page_post,
+                          PAGE_ID, 'http://a.b/')
+        self.assertEqual(self.api.page_tokens.get(PAGE_ID), None)
+        self.api.create_link_page_post(PAGE_ID, 'http://a.b/')
+        self.assertEqual(self.api.page_tokens.get(PAGE_ID), 'new_page_token')
+
+
+class RateLimiterTest(StandInTestCase):
+    """Tests for the client-side rate limiter."""
+
+    def test_token_bucket(self):
+        limiter = facebook.RateLimiter(rate=10, burst=2)
+        start = time.time()
+        for i in range(3):
+            limiter.acquire([('app', 'app_id')])
+        self.assertTrue(time.time() - start >= 0.09)
+
+    def test_usage_headers(self):
+        self.server.routes[('GET', '/act_%s' % ACCOUNT_ID)] = \
+            lambda query, body: (200, {'id': ACCOUNT_ID}, {
+                'X-App-Usage': json.dumps({'call_count': 90}),
+                'X-Ad-Account-Usage': json.dumps({'acc_id_util_pct': 10})})
+        self.api.get_adaccount(ACCOUNT_ID)
+        limiter = self.api.rate_limiter
+        self.assertAlmostEqual(limiter.bucket(('app', 'app_id')).scale, 0.4)
+        self.assertEqual(limiter.bucket(('account', ACCOUNT_ID)).scale, 1.0)
+
+    def test_throttling_error(self):
+        self.api.retry_policy = facebook.RetryPolicy(max_attempts=1)
+        self.server.routes[('GET', '/act_%s/adgroups' % ACCOUNT_ID)] = \
+            lambda query, body: (400, {'error': {
+                'message': 'Too many calls', 'code': 613,
+                'type': 'OAuthException'}})
+        self.assertRaises(facebook.AdsAPIError,
+                          self.api.get_adgroups_by_adaccount, ACCOUNT_ID)
+        bucket = self.api.rate_limiter.bucket(('account', ACCOUNT_ID))
+        self.assertEqual(bucket.backoff, 1)
+        self.assertTrue(bucket.blocked_until > time.time())
+        start = time.time()
+        self.api.get_adaccount(ACCOUNT_ID)
+        self.assertTrue(time.time() - start >= 0.5)
+        self.assertEqual(bucket.backoff, 0.5)
+
+    def test_throttling_scopes(self):
+        limiter = facebook.RateLimiter()
+        app, token = ('app', 'app_id'), ('token', 'proof')
+        for i in range(5):
+            limiter.update([app, token, ('account', '1')], {}, 80004)
+        start = time.time()
+        limiter.acquire([app, token, ('account', '2')])
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertTrue(limiter.bucket(('account', '1')).blocked_until >
+                        time.time() + 10)
+        limiter.update([app, token], {}, 613)
+        self.assertTrue(limiter.bucket(token).blocked_until > time.time())
+        self.assertEqual(limiter.bucket(app).blocked_until, 0)
+        limiter.update([app, token, ('account', '2')], {}, 4)
+        self.assertTrue(limiter.bucket(app).blocked_until > time.time())
+        self.assertEqual(limiter.bucket(('account', '2')).blocked_until, 0)
+
+
+class RetryPolicyTest(StandInTestCase):
+    """Tests for retrying transient failures."""
+
+    def setUp(self):
+        super(RetryPolicyTest, self).setUp()
+        self.api.retry_policy = facebook.RetryPolicy(backoff=0.01)
+        self.failures = 2
+        self.server.routes[('GET', '/6')] = self.flaky
+        self.server.routes[('POST', '/6')] = self.flaky
+
+    def flaky(self, query, body):
+        if self.failures:
+            self.failures -= 1
+            return 503, {'error': {'message': 'Service unavailable',
+                                   'code': 2, 'type': 'FacebookApiException'}}
+        return 200, {'id': '6'}
+
+    def test_get(self):
+        self.assertEqual(self.api.get_adgroup(6), {'id': '6'})
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_max_attempts(self):
+        self.failures = 3
+        self.assertRaises(facebook.AdsAPIError, self.api.get_adgroup, 6)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_post(self):
+        self.assertRaises(facebook.AdsAPIError, self.api.update_adgroup,
+                          6, name='Renamed')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_logging(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = lambda record: records.append(
+            (record.levelname, record.getMessage()))
+        facebook.logger.addHandler(handler)
+        facebook.logger.setLevel(logging.DEBUG)
+        stdout, sys.stdout = sys.stdout, io.BytesIO()
+        try:
+            self.api.get_adgroup(6)
+            facebook.FACEBOOK_API = 'http://127.0.0.1:1'
+            self.assertEqual(self.api.get_adgroup(7), None)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            facebook.logger.removeHandler(handler)
+            facebook.logger.setLevel(logging.NOTSET)
+        self.assertEqual(output, '')
+        self.assertEqual(len([record for record in records
+                              if record[0] == 'DEBUG' and
+                              'request at 6 failed' in record[1]]), 2)
+        self.assertEqual(records[-1][0], 'WARNING')
+        self.assertIn('Giving up on a GET request at 7', records[-1][1])
+
+    def test_batch(self):
+        batch = [self.api.get_adgroup(6, batch=True),
+                 self.api.get_adgroup(7, batch=True)]
+        response = self.api.make_batch_request(batch)
+        self.assertEqual(response, [{'id': '6'},
+                                    {'id': '7', 'method': 'GET'}])
+        self.assertEqual(len(self.server.requests), 3)
+        method, path, body = self.server.requests[-1]
+        retried = json.loads(urlparse.parse_qs(body)['batch'][0])
+        self.assertEqual(retried, batch[:1])
+
+
+class ReportJobManagerTest(StandInTestCase):
+    """Tests for running asynchronous report jobs together."""
+
+    def setUp(self):
+        super(ReportJobManagerTest, self).setUp()
+        self.polls = {}
+        path = '/act_%s/reportstats' % ACCOUNT_ID
+        self.server.routes[('POST', path)] = self.start_job
+        self.server.routes[('GET', path)] = lambda query, body: (
+            200, {'data': [{'report_run_id': query['report_run_id'][0]}]})
+
+    def start_job(self, query, body):
+        job_id = str(1000 + len(self.polls))
+        self.polls[job_id] = 0
+        self.server.routes[('GET', '/' + job_id)] = \
+            lambda query, body: self.job_status(job_id)
+        return 200, {'report_run_id': job_id}
+
+    def job_status(self, job_id):
+        # Job 1000 takes one poll to complete, job 1001 two, and so on
+        self.polls[job_id] += 1
+        percent = min(100, 100 * self.polls[job_id] / (int(job_id) - 999))
+        status = 'Job Completed' if percent == 100 else 'Job Running'
+        if job_id == '1002':
+            status = 'Job Failed'
+        return 200, {'async_status': status,
+                     'async_percent_completion': percent}
+
+    def test_as_completed(self):
+        manager = facebook.ReportJobManager(self.api, min_interval=0.01)
+        for days in (4, 1, 3, 2):
+            manager.submit(ACCOUNT_ID, ['spend'],
+                           date_preset='last_%d_days' % days)
+        jobs = list(manager.as_completed())
+        self.assertEqual([job.job_id for job in jobs],
+                         ['1000', '1002', '1001', '1003'])
+        self.assertEqual(jobs[0].result,
+                         {'data': [{'report_run_id': '1000'}]})
+        self.assertEqual(jobs[1].result, None)
+        self.assertEqual(jobs[1].error.message, '1002: Job Failed')
+        # One batch to start the jobs, then a status batch per poll
+        # and a result batch per poll in which a job completed
+        self.assertEqual(len(self.server.requests), 1 + 4 + 3)
+
+
+class JSONStreamTest(StandInTestCase):
+    """Tests for incremental decoding of large responses."""
+
+    def test_iter_json_array(self):
+        data = {'data': [{'spend': 1.5, 'name': u'\uc2a4\ud3ec\uce20'},
+                         12345678, [], {}],
+                'paging': {'cursors': {'after': 'abc'}}}
+        for chunk_size in (1, 2, 7, 1024):
+            stream = facebook.JSONStream(
+                io.BytesIO(json.dumps(data, ensure_ascii=False).encode(
+                    'utf-8')), chunk_size)
+            rest = {}
+            self.assertEqual(list(stream.iter_array('data', rest)),
+                             data['data'])
+            self.assertEqual(rest, {'paging': data['paging']})
+
+    def test_iter_adreport_stats(self):
+        def reportstats(query, body):
+            if 'after' in query:
+                return 200, {'data': [{'spend': 3}], 'paging': {}}
+            return 200, {'data': [{'spend': 1}, {'spend': 2}], 'paging': {
+                'cursors': {'after': '2'}, 'next': 'next'}}
+        self.server.routes[('GET', '/act_%s/reportstats' % ACCOUNT_ID)] = \
+            reportstats
+        rows = self.api.iter_adreport_stats(
+            ACCOUNT_ID, 'last_28_days', 'all_days', ['spend'])
+        self.assertEqual([row['spend'] for row in rows], [1, 2, 3])
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_lazy_batch(self):
+        batch = [self.api.get_adgroup(i, batch=True) for i in range(60)]
+        response = self.api.make_batch_request(batch, lazy=True)
+        self.assertIsInstance(response, facebook.LazyBatchResponse)
+        self.assertEqual(len(response), 60)
+        self.assertEqual(response[59]['id'], '59')
+        self.assertEqual([data['id'] for data in response[:2]], ['0', '1'])
+
+
+class ShardedReportTest(StandInTestCase):
+    """Tests for time-range sharding of report stats."""
+
+    def setUp(self):
+        super(ShardedReportTest, self).setUp()
+        self.api.retry_policy = facebook.RetryPolicy(max_attempts=1)
+
+    def test_sharded_stats(self):
+        def reportstats(query, body):
+            interval = json.loads(query['time_interval'][0])
+            start, stop = [datetime.datetime(**interval[key])
+                           for key in ('day_start', 'day_stop')]
+            if (stop - start).days > 2:
+                return 500, {'error': {'message': 'Too much data',
+                                       'code': 1, 'type': 'OAuthException'}}
+            if 'after' in query:
+                start += datetime.timedelta(1)
+            row = {'date_start': start.strftime('%Y-%m-%d')}
+            if 'after' in query or (stop - start).days == 1:
+                return 200, {'data': [row], 'paging': {}}
+            return 200, {'data': [row], 'paging': {
+                'cursors': {'after': '1'}, 'next': 'next'}}
+        self.server.routes[('GET', '/act_%s/reportstats' % ACCOUNT_ID)] = \
+            reportstats
+        response = self.api.get_adreport_stats2(
+            ACCOUNT_ID, ['spend'], date_start=datetime.datetime(2026, 1, 1),
+            date_end=datetime.datetime(2026, 1, 10), shard='week')
+        self.assertEqual([row['date_start'] for row in response['data']],
+                         ['2026-01-%02d' % day for day in range(1, 11)])
+        windows = list(self.api.iter_adreport_stats2_windows(
+            ACCOUNT_ID, ['spend'], datetime.datetime(2026, 1, 1),
+            datetime.datetime(2026, 1, 4), 'day'))
+        self.assertEqual([window[0].day for window in windows], [1, 2, 3, 4])
+
+    def test_failed_day(self):
+        self.server.routes[('GET', '/act_%s/reportstats' % ACCOUNT_ID)] = \
+            lambda query, body: (500, {'error': {
+                'message': 'Unknown', 'code': 1, 'type': 'OAuthException'}})
+        with self.assertRaises(facebook.AdsAPIError):
+            self.api.get_adreport_stats2(
+                ACCOUNT_ID, ['spend'],
+                date_start=datetime.datetime(2026, 1, 1),
+                date_end=datetime.datetime(2026, 1, 3), shard=3)
+        # The window is split once before a single day fails
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_permanent_error(self):
+        self.server.routes[('GET', '/act_%s/reportstats' % ACCOUNT_ID)] = \
+            lambda query, body: (400, {'error': {
+                'message': 'Invalid', 'code': 100, 'type': 'OAuthException'}})
+        with self.assertRaises(facebook.AdsAPIError) as cm:
+            self.api.get_adreport_stats2(
+                ACCOUNT_ID, ['spend'],
+                date_start=datetime.datetime(2026, 1, 1),
+                date_end=datetime.datetime(2026, 12, 31), shard='week')
+        self.assertEqual(cm.exception.code, 100)
+        # The 53 weeks go out in two sub-batches, and are not split again
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class ReportSyncTest(StandInTestCase):
+    """Tests for incremental report syncs."""
+
+    def test_sync(self):
+        fetched = []
+
+        def reportstats(query, body):
+            interval = json.loads(query['time_interval'][0])
+            day = datetime.datetime(**interval['day_start'])
+            fetched.append(day.day)
+            return 200, {'data': [{'date_start': day.strftime('%Y-%m-%d'),
+                                   'spend': len(fetched)}]}
+        self.server.routes[('GET', '/act_%s/reportstats' % ACCOUNT_ID)] = \
+            reportstats
+        sync = facebook.ReportSync(self.api)
+        start = datetime.datetime(2026, 1, 1)
+        today = datetime.datetime(2026, 1, 10)
+        self.assertEqual(sync.sync(ACCOUNT_ID, ['spend'], start, today,
+                                   today=today), 10)
+        self.assertEqual(sync.sync(ACCOUNT_ID, ['spend'], start, today,
+                                   today=today), 3)
+        self.assertEqual(sorted(fetched[10:]), [8, 9, 10])
+        today += datetime.timedelta(1)
+        self.assertEqual(sync.sync(ACCOUNT_ID, ['spend'], start, today,
+                                   today=today), 4)
+        rows = list(sync.rows(ACCOUNT_ID, ['spend'], start, today))
+        self.assertEqual([row['date_start'] for row in rows],
+                         ['2026-01-%02d' % day for day in range(1, 12)])
+        self.assertEqual(rows[-1]['spend'], 17)
+        self.assertEqual(sync.sync(ACCOUNT_ID, ['spend'], start,
+                                   today + datetime.timedelta(5),
+                                   today=today), 3)
+        self.assertEqual(
+            list(sync.rows(ACCOUNT_ID, ['clicks'], start, today)), [])
+        sync.close()
+
+    def test_actions_group_by(self):
+        def reportstats(query, body):
+            interval = json.loads(query['time_interval'][0])
+            day = datetime.datetime(**interval['day_start'])
+            return 200, {'data': [{'date_start': day.strftime('%Y-%m-%d'),
+                                   'group_by': query['actions_group_by']}]}
+        self.server.routes[('GET', '/act_%s/reportstats' % ACCOUNT_ID)] = \
+            reportstats
+        sync = facebook.ReportSync(self.api)
+        day = datetime.datetime(2026, 1, 1)
+        for group_by in (['action_type'], ['action_device']):
+            self.assertEqual(sync.sync(ACCOUNT_ID, ['actions'], day, day,
+                                       actions_group_by=group_by,
+                                       today=day), 1)
+        for group_by in (['action_type'], ['action_device']):
+            rows = list(sync.rows(ACCOUNT_ID, ['actions'], day, day,
+                                  actions_group_by=group_by))
+            self.assertEqual([row['group_by'] for row in rows],
+                             [[str(group_by)]])
+        sync.close()
+
+
+class ColumnarReportTest(unittest.TestCase):
+    """Tests for the columnar report container."""
+    rows = [
+        {'age': '18-24', 'gender': 'male', 'spend': 1.5, 'clicks': '3'},
+        {'age': '18-24', 'gender': 'female', 'spend': 2, 'clicks': None},
+        {'age': '25-34', 'gender': 'male', 'spend': None, 'clicks': 4},
+        {'age': '18-24', 'gender': 'male', 'spend': 0.5, 'reach': 10},
+    ]
+
+    def test_columns(self):
+        report = facebook.ColumnarReport.from_rows(self.rows, ['spend'])
+        self.assertEqual(len(report), 4)
+        self.assertEqual(report.columns['spend'].kind, 'numeric')
+        self.assertEqual(report.columns['age'].kind, 'string')
+        self.assertEqual(report.columns['age'].dictionary, ['18-24', '25-34'])
+        self.assertEqual(report.column('reach'), [None, None, None, 10.0])
+        self.assertEqual(report.column('clicks'), [3.0, None, 4.0, None])
+        self.assertEqual(report.sum('spend'), 4.0)
+        self.assertEqual(list(report)[2]['age'], '25-34')
+
+    def test_group_by(self):
+        report = facebook.ColumnarReport.from_rows(self.rows)
+        self.assertEqual(report.group_by('age', ['spend']), {
+            '18-24': {'spend': 4.0}, '25-34': {'spend': 0.0}})
+        self.assertEqual(
+            report.group_by(['age', 'gender'], ['spend', 'clicks'])[
+                ('18-24', 'male')], {'spend': 2.0, 'clicks': 3.0})
+
+    def test_ids_and_dimensions(self):
+        rows = [{'adgroup_id': '23842612345678901', 'account_id': 42,
+                 'adgroup_name': '2014', 'date_start': '2014-05-01',
+                 'spend': '1.5'},
+                {'adgroup_id': '23842612345678902', 'account_id': 42,
+                 'adgroup_name': 'Spring', 'date_start': '2014-05-02',
+                 'spend': 2}]
+        report = facebook.ColumnarReport.from_rows(rows)
+        self.assertEqual(report.columns['adgroup_id'].kind, 'string')
+        self.assertEqual(report.columns['adgroup_name'].kind, 'string')
+        self.assertEqual(report.columns['spend'].kind, 'numeric')
+        self.assertEqual(list(report)[0]['adgroup_id'], '23842612345678901')
+        self.assertEqual(report.column('account_id'), ['42', '42'])
+        self.assertEqual(report.column('adgroup_name'), ['2014', 'Spring'])
+        self.assertEqual(report.group_by('adgroup_id'), {
+            '23842612345678901': {}, '23842612345678902': {}})
+
+    def test_mixed_column(self):
+        report = facebook.ColumnarReport.from_rows(
+            [{'value': 1}, {'value': 'n/a'}, {'value': [2]}])
+        self.assertEqual(report.columns['value'].kind, 'object')
+        self.assertEqual(report.column('value'), [1.0, 'n/a', [2]])
+
+    @unittest.skipIf(facebook.numpy is None, 'NumPy is not installed')
+    def test_to_numpy(self):
+        report = facebook.ColumnarReport.from_rows(self.rows)
+        spend = report.to_numpy('spend')
+        spend[0] = 10
+        self.assertEqual(report.column('spend')[0], 10.0)
+
+
 if __name__ == '__main__':
     unittest.main()